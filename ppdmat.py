@@ -6,343 +6,1056 @@ __email__ = " "
 __date__ = "2023-09-26"
 
 import argparse
-from operator import index
-from unicodedata import name
-import requests
-import urllib3
+import codecs
+import cProfile
+import csv
+import hashlib
+import importlib.util
+import os
 import sys
 import json
 import time
-import pandas as pd
-import numpy as np
+import queue
+from contextlib import contextmanager, nullcontext
+import random
+import re
+import signal
+import sqlite3
+import threading
 from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-pd.options.mode.chained_assignment = None
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
-writer = pd.ExcelWriter('ppdmdetails.xlsx', engine='xlsxwriter')
-urllib3.disable_warnings()
-summary_dict = {'PPDM SERVER DETAILS': ''}
+def lazy_import(name):
+    # Import a module on its first attribute access, so --help and importing ppdmat do not pay for the heavy libraries
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+requests = lazy_import('requests')
+urllib3 = lazy_import('urllib3')
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+xlsxwriter = lazy_import('xlsxwriter')
+
+TIMEFORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+SYNC_LOOKBACK = timedelta(days=1)
+RETRY_STATUS = [429, 500, 502, 503, 504]
+STREAM_CHUNK = 65536
+# Results the analytics count as a successful backup, OK_WITH_ERRORS, CANCELED and the other results count as failures
+SUCCESS_STATUSES = ['OK']
+# Days of capacity snapshots the growth of Data Domain systems and MTrees is fitted over
+CAPACITY_DAYS = 90
+# Seconds the pages of slowly changing endpoints are served from the response cache
+CACHE_TTL = {'/configurations': 6 * 3600, '/licenses': 24 * 3600, '/inventory-sources': 6 * 3600, '/storage-systems': 2 * 3600,
+             '/protection-policies': 2 * 3600, '/protection-engines': 2 * 3600}
+measure_memory = threading.Event()
+EXCEL_EPOCH = datetime(1899, 12, 30)
+# Run instrumentation, the endpoint being collected is kept per thread
+instrument = threading.local()
+stage_timings = {}
+stage_log = []
+request_log = []
+normalize_log = []
+cprofile_stages = {}
 
 def get_args():
     # Get command line args from the user
     parser = argparse.ArgumentParser(
         description='Script to gather PowerProtect Data Manager Information')
-    parser.add_argument('-s', '--server', required=True,
+    parser.add_argument('-s', '--server', required=False,
                         action='store', help='PPDM DNS name or IP')
-    parser.add_argument('-usr', '--user', required=False, action='store',
+    parser.add_argument('-usr', '-u', '--user', required=False, action='store',
                         default='admin', help='User')
-    parser.add_argument('-pwd', '--password', required=True, action='store',
-                        help='Password')
+    parser.add_argument('-pwd', '-p', '--password', required=False, action='store',
+                        help='Password, also used for the inventory servers without one')
+    parser.add_argument('-i', '--inventory', required=False, action='store',
+                        help='CSV or JSON file of PPDM servers (server, user, password, port) to collect as one fleet')
+    parser.add_argument('-fw', '--fleet-workers', required=False, action='store', type=int, default=4,
+                        help='Number of inventory servers collected in parallel')
+    parser.add_argument('-mc', '--max-calls', required=False, action='store', type=int, default=16,
+                        help='Maximum number of concurrent API calls across all the inventory servers')
     parser.add_argument('-rd', '--rptdays', required=False, action='store', default=30,
                         help='Report period')                    
+    parser.add_argument('--port', required=False, action='store', default='8443',
+                        help='PPDM REST API port')
+    parser.add_argument('--http', required=False, action='store_true',
+                        help='Use plain HTTP, for a local test server such as ppdmmock.py')
+    parser.add_argument('-ps', '--pagesize', required=False, action='store', type=int, default=1000,
+                        help='Number of records requested per page')
+    parser.add_argument('-sh', '--shard', required=False, action='store', choices=['day', 'week'],
+                        help='Split the activities report window into day or week queries fetched in parallel')
+    parser.add_argument('-st', '--store', required=False, action='store',
+                        help='Local SQLite file to keep activities in, only new activities are downloaded')
+    parser.add_argument('-t', '--timeout', required=False, action='store', type=float, default=120,
+                        help='Timeout in seconds for each API request')
+    parser.add_argument('-r', '--retries', required=False, action='store', type=int, default=5,
+                        help='Number of retries for a failed or throttled API request')
+    parser.add_argument('-o', '--output', required=False, action='store',
+                        help='Output file, or directory for the csv, jsonl and parquet formats')
+    parser.add_argument('-f', '--format', required=False, action='store', choices=list(OUTPUTS), default='xlsx',
+                        help='Output format')
+    parser.add_argument('-mr', '--memreport', required=False, action='store_true',
+                        help='Print the memory used by the collected records before and after typing them')
+    parser.add_argument('-pf', '--profile', required=False, action='store',
+                        help='Write the timings, memory and API requests of the run to this .json or .csv file')
+    parser.add_argument('-cp', '--cprofile', required=False, action='append', choices=['login', 'collection', 'summaryxls', 'chartxls', 'analytics', 'capacity', 'outxls', 'snapshot', 'compare', 'logout'],
+                        help='Run a stage under cProfile, only the main thread of the stage is profiled')
+    parser.add_argument('-nc', '--no-cache', required=False, action='store_true',
+                        help='Do not cache the responses of slowly changing endpoints')
+    parser.add_argument('-rf', '--refresh', required=False, action='store_true',
+                        help='Ignore the responses cached by earlier runs and cache fresh ones')
+    parser.add_argument('-cd', '--cache-dir', required=False, action='store',
+                        help='Directory to keep cached responses in between runs, by default they are only kept in memory')
+    parser.add_argument('-cs', '--cache-size', required=False, action='store', type=float, default=256,
+                        help='Maximum size of the response cache in MB')
+    parser.add_argument('-sn', '--snapshot', required=False, action='store',
+                        help='Directory a parquet snapshot of the collected records is kept in, one sub directory per run')
+    parser.add_argument('-cmp', '--compare', required=False, action='store', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Write the changes between two snapshot directories to ppdmchanges.xlsx or the -o output, without contacting PPDM')
+    parser.add_argument('-np', '--no-projection', required=False, action='store_true',
+                        help='Download whole records instead of asking PPDM for the report fields only')
+    parser.add_argument('-wt', '--watch', required=False, action='store', type=float,
+                        help='Keep running and poll new activities every this many seconds, serving metrics and reports over HTTP')
+    parser.add_argument('-wi', '--watch-inventory', required=False, action='store', type=float, default=900,
+                        help='Seconds between refreshes of the other endpoints in watch mode')
+    parser.add_argument('-wo', '--watch-overlap', required=False, action='store', type=float, default=300,
+                        help='Seconds before the newest activity each watch mode poll looks back')
+    parser.add_argument('-mh', '--metrics-host', required=False, action='store', default='127.0.0.1',
+                        help='Address the watch mode serves /metrics and /report on')
+    parser.add_argument('-mp', '--metrics-port', required=False, action='store', type=int, default=9721,
+                        help='Port the watch mode serves /metrics and /report on')
+    parser.add_argument('-w', '--workers', required=False, action='store', type=int, default=4,
+                        help='Maximum number of concurrent API calls')
     args = parser.parse_args()
+    if not args.inventory and not args.compare and not (args.server and args.password):
+        parser.error('the following arguments are required: -s/--server, -pwd/--password, or -i/--inventory')
+    if args.watch and args.inventory:
+        parser.error('-wt/--watch keeps the session of one server open, it cannot be used with -i/--inventory')
     return args
 
-def authenticate(ppdm, user, password, uri):
+class PpdmApi:
+    # REST client shared by all the API calls, one pooled session holding the bearer token
+    def __init__(self, ppdm, user, password, uri, poolsize=4, timeout=120, retries=5, limiter=None, cache=None, projection=True):
+        self.ppdm, self.user, self.password, self.uri = ppdm, user, password, uri
+        self.cache = cache
+        self.timeout, self.retries = timeout, retries
+        # Paths that answered 400 to the fields parameter or a pushed down filter, queried without them from then on
+        self.projection, self.unprojected = projection, set()
+        # Semaphore capping the API calls in flight, shared by the sessions of a fleet
+        self.limiter = limiter or nullcontext()
+        self.holding = threading.local()
+        self.token, self.expiry = None, None
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.verify = False
+        # Every collector runs a prefetch thread next to its own, keep a connection for both
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, poolsize) * 2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+    def login(self):
+        payload = json.dumps({'username': self.user, 'password': self.password})
+        response = self.request('POST', '/login', data=payload, auth=False)
+        body = response.json()
+        self.token = body['access_token']
+        if body.get('expires_in'):
+            self.expiry = time.monotonic() + int(body['expires_in'])
+        return self.token
+
+    def refresh(self, token):
+        # Login again unless another thread already replaced the expired token
+        with self.lock:
+            if self.token == token:
+                self.login()
+
+    def backoff(self, attempt, response=None):
+        # Exponential backoff with full jitter, a Retry-After header from PPDM wins
+        delay = random.uniform(0, min(60, 2 ** attempt))
+        if response is not None and str(response.headers.get('Retry-After', '')).isdigit():
+            delay = int(response.headers['Retry-After'])
+        time.sleep(delay)
+
+    @contextmanager
+    def slot(self):
+        # Take one call of the limiter, a thread that already holds one goes on
+        if getattr(self.holding, 'slot', False):
+            yield
+            return
+        with self.limiter:
+            self.holding.slot = True
+            try:
+                yield
+            finally:
+                self.holding.slot = False
+
+    def request(self, method, path, auth=True, **kwargs):
+        refreshed, attempt, calls = False, 0, 0
+        while True:
+            calls += 1
+            headers = {}
+            if auth:
+                if self.expiry is not None and time.monotonic() > self.expiry - 60:
+                    self.refresh(self.token)
+                headers['Authorization'] = 'Bearer {}'.format(self.token)
+            try:
+                with self.slot():
+                    response = self.session.request(method, self.uri + path, headers=headers, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.retries:
+                    raise
+                self.backoff(attempt)
+                attempt += 1
+                continue
+            if response.status_code == 401 and auth and not refreshed:
+                # The call with the renewed token does not count against the retries
+                response.close()
+                self.refresh(headers['Authorization'].split(' ', 1)[1])
+                refreshed = True
+                continue
+            if response.status_code in RETRY_STATUS and attempt < self.retries:
+                # A streamed response holds its pooled connection until it is closed
+                response.close()
+                self.backoff(attempt, response)
+                attempt += 1
+                continue
+            response.raise_for_status()
+            response.attempts = calls
+            return response
+
+    def get(self, path, params=None, stream=False):
+        return self.request('GET', path, params=params, stream=stream)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+class ResponseCache:
+    # Page bodies of the CACHE_TTL endpoints, kept in memory and optionally on disk, identical requests in flight share one call
+    def __init__(self, directory=None, maxbytes=256 * 1024 * 1024, refresh=False):
+        self.directory, self.maxbytes, self.refresh = directory, maxbytes, refresh
+        self.started = time.time()
+        self.memory, self.inflight = {}, {}
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.shared = 0, 0, 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, url, params):
+        return json.dumps([url, sorted((params or {}).items())])
+
+    def file(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.cache')
+
+    def read(self, key):
+        # Body stored on disk by an earlier run, expired entries are removed, --refresh ignores what earlier runs stored
+        if not self.directory:
+            return None
+        path = self.file(key)
+        try:
+            with open(path, 'rb') as cached:
+                header = json.loads(cached.readline())
+                body = cached.read()
+        except (OSError, ValueError):
+            return None
+        if header.get('key') != key or header['expires'] < time.time():
+            self.remove(path)
+            return None
+        if self.refresh and header['stored'] < self.started:
+            return None
+        os.utime(path)
+        return header['expires'], body
+
+    def write(self, key, expires, body):
+        if not self.directory:
+            return
+        path = self.file(key)
+        header = json.dumps({'key': key, 'stored': time.time(), 'expires': expires}).encode()
+        with open(path + '.tmp', 'wb') as cached:
+            cached.write(header + b'\n' + body)
+        os.replace(path + '.tmp', path)
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        # Remove the least recently used files until the cache directory fits in maxbytes
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.maxbytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def remember(self, key, expires, body):
+        # Keep the body in memory, dropping the oldest entries over maxbytes
+        self.memory[key] = (expires, body)
+        total = sum(len(entry[1]) for entry in self.memory.values())
+        for old in list(self.memory):
+            if total <= self.maxbytes:
+                break
+            total -= len(self.memory.pop(old)[1])
+
+    def fetch(self, url, params, ttl, call):
+        # Return the body and whether it was a cache hit, a miss or shared with an identical call in flight
+        key = self.key(url, params)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1], 'hit'
+            waiter = self.inflight.get(key)
+            owner = waiter is None
+            if owner:
+                waiter = self.inflight[key] = {'done': threading.Event()}
+        if not owner:
+            waiter['done'].wait()
+            if 'error' in waiter:
+                raise waiter['error']
+            with self.lock:
+                self.shared += 1
+            return waiter['body'], 'shared'
+        try:
+            entry, source = self.read(key), 'hit'
+            if entry is None:
+                entry, source = (time.time() + ttl, call()), 'miss'
+                self.write(key, *entry)
+            with self.lock:
+                self.remember(key, *entry)
+                if source == 'hit':
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            waiter['body'] = entry[1]
+            return entry[1], source
+        except Exception as err:
+            waiter['error'] = err
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            waiter['done'].set()
+
+def open_cache(args):
+    # Response cache of the run, None with --no-cache
+    if args.no_cache:
+        return None
+    return ResponseCache(args.cache_dir, int(args.cache_size * 1024 * 1024), args.refresh)
+
+def print_cache(cache):
+    if cache is not None:
+        print('Response cache: {} hits, {} misses, {} shared with a call in flight'.format(cache.hits, cache.misses, cache.shared))
+
+def authenticate(api):
     # Login
-    suffixurl = "/login"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json'}
-    payload = '{"username": "%s", "password": "%s"}' % (user, password)
     try:
-        response = requests.post(uri, data=payload, headers=headers, verify=False)
-        response.raise_for_status()
+        api.login()
     except requests.exceptions.ConnectionError as err:
-        print('Error Connecting to {}: {}'.format(ppdm, err))
+        print('Error Connecting to {}: {}'.format(api.ppdm, err))
         sys.exit(1)
     except requests.exceptions.Timeout as err:
-        print('Connection timed out {}: {}'.format(ppdm, err))
+        print('Connection timed out {}: {}'.format(api.ppdm, err))
         sys.exit(1)
     except requests.exceptions.RequestException as err:
-        print("The call {} {} failed with exception:{}".format(response.request.method, response.url, err))
+        print('Login failed for user: {}, error: {}'.format(api.user, err))
         sys.exit(1)
-    if (response.status_code != 200):
-        raise Exception('Login failed for user: {}, code: {}, body: {}'.format(
-            user, response.status_code, response.text))
-    print('Logged in with user: {} to PPDM: {}'.format(user, ppdm))
-    token = response.json()['access_token']
-    return token
-
-def get_appliance_config(uri, token):
-    suffixurl = "/configurations"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    params = {'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    ac_df = pd.json_normalize(response.json()['content'], record_path=['networks'])
-    return ac_df
-
-def get_policies(uri, token):
-    # Get all the policies
-    suffixurl = "/protection-policies"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    filter = 'type eq "ACTIVE" and createdAt gt "2010-05-06T11:20:21.843Z"'
-    params = {'filter': filter, 'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    FIELDS1 = ["name", "assetType", "type", "enabled", "encrypted", "dataConsistency", "summary.numberOfAssets", "summary.totalAssetCapacity", "summary.totalAssetProtectionCapacity", "summary.lastExecutionStatus"]
-    df1 = pd.json_normalize(response.json()['content'])
-    FIELDS2 = list(df1.keys())
-    FIELDS = []
-    for element in FIELDS1:
-        if element in FIELDS2:
-            FIELDS.append(element)
-    po_df = df1[FIELDS]
-    po_df.rename(columns={"name":'Name', "assetType":'AssetType', "type":'Type', "enabled":'Enabled', "encrypted":'Encrypted', "dataConsistency":'Data Consistency', "summary.numberOfAssets":'# of Assets', "summary.totalAssetCapacity":'TotalAssetCapacity(b)', "summary.totalAssetProtectionCapacity":'TotalAssetProtectionCapacity(b)', "summary.lastExecutionStatus":'Last Status'}, inplace=True)
-    return po_df
-
-def get_assets(uri, token):
-    # Get all the Assets
-    suffixurl = "/assets"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    filter = 'createdAt gt "2010-05-06T11:20:21.843Z"'
-    params = {'filter': filter, 'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    FIELDS1 = ["id", "name", "type", "protectionStatus", "size", "subtype", "protectionPolicy.name", "protectionCapacity.size", "lastAvailableCopyTime", "details.k8s.inventorySourceName", "details.vm.guestOS", "details.vm.vcenterName", "details.vm.esxName", "details.database.clusterName"]
-    df2 = pd.json_normalize(response.json()['content'])
-    FIELDS2 = list(df2.keys())
-    FIELDS = []
-    for element in FIELDS1:
-        if element in FIELDS2:
-            FIELDS.append(element)
-    as_df = df2[FIELDS]
-    as_df.rename(columns={"name":'Name', "type":'Type', "protectionStatus":'Protection Status', "size":'Size', "subtype":'SubType', "protectionPolicy.name":'PolicyName', "protectionCapacity.size":'Protection Capacity(b)', "lastAvailableCopyTime":'LastBackupCopy', "details.k8s.inventorySourceName":'K8S Inv Source', "details.vm.guestOS":'VM Guest OS', "details.vm.vcenterName":'vCenterName', "details.vm.esxName":'ESX Name', "details.database.clusterName":'Database ClusterName'}, inplace=True)
-    return as_df
-
-def get_inv_src(uri, token):
-    # Get all the Inventory Sources
-    suffixurl = "/inventory-sources"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    params = {'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    FIELDS1 = ["name", "type", "version", "lastDiscoveryResult.status", "address"] 
-    df3 = pd.json_normalize(response.json()['content'])
-    FIELDS2 = list(df3.keys())
-    FIELDS = []
-    for element in FIELDS1:
-        if element in FIELDS2:
-            FIELDS.append(element)
-    is_df = df3[FIELDS]
-    return is_df
-
-def get_storage(uri, token):
-    # Get all the Storage Systems
-    suffixurl = "/storage-systems"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    params = {'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    FIELDS1 = ["name", "type", "details.dataDomain.totalSize", "details.dataDomain.totalUsed", "capacityUtilization", "details.dataDomain.compressionFactor", "lastDiscoveryStatus", "lastDiscovered", "readiness", "details.dataDomain.version", "details.dataDomain.model", "details.dataDomain.serialNumber"] 
-    df4 = pd.json_normalize(response.json()['content'])
-    FIELDS2 = list(df4.keys())
-    FIELDS = []
-    for element in FIELDS1:
-        if element in FIELDS2:
-            FIELDS.append(element)
-    st_df = df4[FIELDS]
-    return st_df
-
-def get_protection_eng(uri, token):
-    # Get all the Protection Engines
-    suffixurl = "/protection-engines"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    params = {'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    pe_df = pd.json_normalize(response.json()['content'])
-    return pe_df
-
-def get_app_agents(uri, token):
-    # Get all the App Agents
-    suffixurl = "/protection-engines"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    params = {'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    df7 = pd.json_normalize(response.json()['content'])
-    print ("Written App agents information to ppdmdetails.xls")
-    return df7
-
-def get_activities(uri, token, window):
-    # Get all the Activities
-    suffixurl = "/activities"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    filter = 'category eq "PROTECT" and classType in ("TASK") and state in ("COMPLETED") and createTime gt "{}"'.format(window)
-    orderby = 'createTime DESC'
-    pageSize = '10000'
-    params = {'filter': filter, 'orderby': orderby, 'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    FIELDS1 = ["protectionPolicy.name", "asset.name", "category", "date", "createTime", "updateTime", "duration", "state", "result.status", "name", "host.name", "stats.assetSizeInBytes", "stats.bytesTransferred" , "stats.postCompBytes", "stats.dedupeRatio", "stats.reductionPercentage"]
-    df8 = pd.json_normalize(response.json()['content'])
-    # df8['date'] = pd.to_datetime(df8['createTime']).dt.date
-    FIELDS2 = list(df8.keys())
-    FIELDS = []
-    for element in FIELDS1:
-        if element in FIELDS2:
-            FIELDS.append(element)
-    ac_df = df8[FIELDS]
-    ac_df.rename(columns={"protectionPolicy.name": 'Policy Name', "asset.name": "Asset Name", "category": "Category", "date": "Date", "duration": "Duration (sec)", "state": "State", "result.status": "Status", "name": "Task", "host.name": "Client Name", "stats.assetSizeInBytes": "Asset Size", "stats.bytesTransferred":"Data Transferred" , "stats.postCompBytes": "PostComp", "stats.dedupeRatio": "Dedupe Ratio", "stats.reductionPercentage": "Reduction %"}, inplace=True)
-    ac_df = ac_df[ac_df["Policy Name"].notnull()]
-    return ac_df
-
-def get_jobgroups(uri, token, window):
-    # Get all the JOB Groups
-    suffixurl = "/activities"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    filter = 'category eq "PROTECT" and classType in ("JOB_GROUP") and state in ("COMPLETED") and createdTime gt "{}"'.format(window)
-    orderby = 'createTime DESC'
-    pageSize = '10000'
-    params = {'filter': filter, 'orderby': orderby, 'pageSize': pageSize}
-    try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    FIELDS1 = ["protectionPolicy.name", "protectionPolicy.type", "stats.numberOfAssets", "stats.numberOfProtectedAssets", "category", "subcategory", "classType", "startTime", "endTime", "duration", "stats.bytesTransferredThroughput", "state", "result.status", "stats.assetSizeInBytes", "stats.preCompBytes", "stats.postCompBytes", "stats.bytesTransferred", "stats.dedupeRatio", "stats.reductionPercentage"]
-    df9 = pd.json_normalize(response.json()['content'])
-    FIELDS2 = list(df9.keys())
-    FIELDS = []
-    for element in FIELDS1:
-        if element in FIELDS2:
-            FIELDS.append(element)
-    jg_df = df9[FIELDS]
-    jg_df['startTime'] = pd.to_datetime(jg_df['startTime']).dt.strftime('%Y-%m-%d %r')
-    jg_df['endTime'] = pd.to_datetime(jg_df['endTime']).dt.strftime('%Y-%m-%d %r')
-    jg_df.rename(columns={"protectionPolicy.name":'Policy Name', "protectionPolicy.type":'Policy Type', "stats.numberOfAssets":'# of Assets', "stats.numberOfProtectedAssets":'# of Protected Assets', "category":'Category', "subcategory":'SubCategory', "classType":'JobType', "duration":'Duration(sec)', "stats.bytesTransferredThroughput":'Throughput(bytes)', "result.status":'Status', "stats.assetSizeInBytes":'Asset Size(b)', "stats.preCompBytes":'PreComp(b)', "stats.postCompBytes":'PostComp(b)', "stats.bytesTransferred":'Bytes Transferred(b)', "stats.dedupeRatio":'Dedupe Ratio', "stats.reductionPercentage":'Reduction %'}, inplace=True)
-    return jg_df
-
-
-def get_ddmtrees(uri, token):
-    # Get all the DD MTrees
-    suffixurl = "/datadomain-mtrees"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    params = {'pageSize': pageSize}
+    print('Logged in with user: {} to PPDM: {}'.format(api.user, api.ppdm))
+    return api.token
+
+def stream_body(chunks):
+    # Parse a JSON object body while it downloads, the items of its content array are yielded one at a time
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf, pos, done = '', 0, False
+    def fill():
+        nonlocal buf, pos, done
+        chunk = next(chunks, None)
+        if chunk is None:
+            buf, pos, done = buf[pos:] + text.decode(b'', final=True), 0, True
+        else:
+            buf, pos = buf[pos:] + text.decode(chunk), 0
+    def skip():
+        # Next non blank character, read more of the body at the end of the buffer
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if done:
+                raise ValueError('Truncated JSON body')
+            fill()
+    def value():
+        # Decode the next value, a value ending at the end of the buffer may be cut short so it is decoded again after a read,
+        # as is a number followed by a '.', 'e' or sign whose digits are still to come
+        nonlocal pos
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                if done or end < len(buf) and not (isinstance(obj, (int, float)) and buf[end] in '.eE+-0123456789'):
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if done:
+                    raise
+            fill()
+    def expect(chars):
+        nonlocal pos
+        char = skip()
+        if char not in chars:
+            raise ValueError('Unexpected {!r} in JSON body'.format(char))
+        pos += 1
+        return char
+    expect('{')
+    if skip() == '}':
+        return
+    while True:
+        skip()
+        key = value()
+        expect(':')
+        if key == 'content' and skip() == '[':
+            pos += 1
+            if skip() == ']':
+                pos += 1
+            else:
+                while True:
+                    skip()
+                    yield key, value()
+                    if expect(',]') == ']':
+                        break
+        else:
+            skip()
+            yield key, value()
+        if expect(',}') == '}':
+            return
+
+def stream_fields(data, fields):
+    # Build the columns of the wanted dotted fields straight from the streamed content items, without keeping the records
+    paths = [(field, field.split('.')) for field in fields]
+    roots = {parts[0] for _, parts in paths} | {'id'}
+    columns = {field: [] for field in fields}
+    seen, extra = set(), False
+    page, records, size, waited = {}, 0, 0, 0.0
+    def chunks():
+        nonlocal size, waited
+        body = iter(data)
+        while True:
+            start = time.perf_counter()
+            chunk = next(body, None)
+            waited += time.perf_counter() - start
+            if chunk is None:
+                return
+            size += len(chunk)
+            yield chunk
+    start = time.perf_counter()
+    for key, item in stream_body(chunks()):
+        if key == 'page':
+            page = item or {}
+        if key != 'content':
+            continue
+        records += 1
+        # Attributes outside the fields show the server did not project the records
+        extra = extra or isinstance(item, dict) and not item.keys() <= roots
+        for field, parts in paths:
+            value = item
+            for part in parts:
+                if isinstance(value, dict) and part in value:
+                    value = value[part]
+                else:
+                    value = np.nan
+                    break
+            else:
+                # json_normalize flattens a dict further, so the field itself is not a column
+                if isinstance(value, dict):
+                    value = np.nan
+                else:
+                    seen.add(field)
+            columns[field].append(value)
+    # Fields missing from every record of the page are left out, as json_normalize does
+    df = pd.DataFrame({field: columns[field] for field in fields if field in seen}, index=pd.RangeIndex(records))
+    return df, page, records, size, time.perf_counter() - start - waited, extra
+
+def pushdown_params(api, path, params, fields=None, pushdown=None):
+    # Ask the server for just the fields and the rows of the pushdown filter, unless it rejected them before
+    if not api.projection or path in api.unprojected or not (fields or pushdown):
+        return params
+    params = dict(params)
+    if fields:
+        params['fields'] = ','.join(fields)
+    if pushdown:
+        params['filter'] = '{} and {}'.format(params['filter'], pushdown) if params.get('filter') else pushdown
+    return params
+
+def get_pages(api, path, params, pagesize, fields=None, pushdown=None):
+    # Yield the content of each page, the next page is prefetched while the caller processes the current one
+    # With fields set the content is streamed into a frame of just those fields instead of a list of records
+    # The fields and the pushdown filter clause are sent to the server, the fields are kept on the client as well
+    endpoint = current_endpoint(path)
+    def fetch(params):
+        start = time.perf_counter()
+        response, source, attempts, extra = None, '', 0, False
+        query = pushdown_params(api, path, params, fields, pushdown)
+        projection = 'server' if query is not params else 'client' if fields else ''
+        def download():
+            # Body of a cacheable page, only called when the cache has no fresh copy
+            nonlocal attempts
+            response = api.get(path, query)
+            attempts = response.attempts
+            return response.content
+        try:
+            # The call slot is held until a streamed body is read, so -w caps the downloads in flight
+            with api.slot():
+                if api.cache is not None and path in CACHE_TTL:
+                    data, source = api.cache.fetch(api.uri + path, query, CACHE_TTL[path], download)
+                    status, chunks = 200, [data]
+                else:
+                    response = api.get(path, query, stream=fields is not None)
+                    status, attempts = response.status_code, response.attempts
+                    chunks = [response.content] if fields is None else response.iter_content(STREAM_CHUNK)
+                with response or nullcontext():
+                    if fields is None:
+                        received = time.perf_counter()
+                        body = json.loads(chunks[0])
+                        content = body.get('content') or []
+                        page, records, size = body.get('page') or {}, len(content), len(chunks[0])
+                        parse = time.perf_counter() - received
+                    else:
+                        content, page, records, size, parse, extra = stream_fields(chunks, fields)
+        except requests.exceptions.RequestException as err:
+            if projection == 'server' and isinstance(err, requests.exceptions.HTTPError) and err.response.status_code == 400:
+                # Older PPDM releases reject the fields parameter or the filter, query the page as before
+                print('PPDM rejected the fields or filter of {}, selecting them on the client'.format(path))
+                api.unprojected.add(path)
+                return fetch(params)
+            raise Exception('Failed to query {}, params: {}, error: {}'.format(path, query, err))
+        if projection == 'server' and fields and records and extra:
+            projection = 'ignored'
+        request_log.append({'endpoint': endpoint, 'path': path, 'status': status, 'attempts': attempts, 'cache': source, 'projection': projection,
+                            'bytes': size, 'records': records, 'seconds': time.perf_counter() - start - parse,
+                            'parse_seconds': parse})
+        return content, page, records
+    params = dict(params, pageSize=str(pagesize))
+    number = 1
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        future = prefetch.submit(fetch, params)
+        while future is not None:
+            content, page, records = future.result()
+            future = None
+            if page.get('queryState'):
+                # Cursor based paging, required by PPDM past the first 10000 records
+                nextparams = dict(params, queryState=page['queryState'])
+            elif 'totalPages' in page:
+                nextparams = dict(params, page=str(number + 1)) if number < int(page['totalPages']) else None
+            else:
+                nextparams = dict(params, page=str(number + 1)) if records >= pagesize else None
+            if records and nextparams is not None:
+                number += 1
+                future = prefetch.submit(fetch, nextparams)
+            yield content
+
+def apply_dtypes(df, dtypes):
+    # Cast the columns of a page to the compact types of the collector schema
+    for column, dtype in dtypes.items():
+        if column not in df.columns or str(df[column].dtype) == dtype:
+            continue
+        if dtype.startswith('datetime64'):
+            df[column] = pd.to_datetime(df[column], utc=True, format='ISO8601', errors='coerce')
+        elif dtype == 'category':
+            df[column] = df[column].astype(dtype)
+        else:
+            values = pd.to_numeric(df[column], errors='coerce')
+            try:
+                df[column] = values.astype(dtype)
+            except (TypeError, ValueError):
+                # Fractional values in a column declared as integer
+                df[column] = values
+    return df
+
+def concat_pages(frames, dtypes=None):
+    # Concatenate the pages, categories are merged first as pandas falls back to object for differing categories
+    if len(frames) == 1:
+        return frames[0]
+    for column in [column for column, dtype in (dtypes or {}).items() if dtype == 'category']:
+        # Empty frames have no categories to add and may type them differently
+        values = [df[column] for df in frames if column in df.columns and len(df)]
+        if values:
+            categories = pd.api.types.union_categoricals(values, ignore_order=True).categories
+            for df in frames:
+                if column in df.columns:
+                    df[column] = df[column].cat.set_categories(categories)
+    df = pd.concat(frames, ignore_index=True)
+    return apply_dtypes(df, dtypes) if dtypes else df
+
+def normalize_pages(pages, fields=None, record_path=None, dtypes=None):
+    # Flatten one page at a time, keep only the wanted fields and cast them, so the raw records of a page can be freed
+    frames = []
+    untyped = 0
+    seconds = 0
+    for content in pages:
+        start = time.perf_counter()
+        # Streamed pages arrive as frames of the wanted fields already
+        df = content if isinstance(content, pd.DataFrame) else pd.json_normalize(content, record_path=record_path)
+        if fields is not None:
+            df = df[[field for field in fields if field in df.columns]]
+        if dtypes:
+            if measure_memory.is_set():
+                untyped += df.memory_usage(deep=True).sum()
+            df = apply_dtypes(df, dtypes)
+        frames.append(df)
+        seconds += time.perf_counter() - start
+    normalize_log.append({'endpoint': current_endpoint(), 'pages': len(frames), 'normalize_seconds': seconds})
+    if not frames:
+        return apply_dtypes(pd.DataFrame(columns=fields or []), dtypes or {})
+    df = concat_pages(frames, dtypes)
+    if fields is not None:
+        # Fields no record had, or an empty result, still get their typed columns
+        missing = [field for field in fields if field not in df.columns]
+        df = df.reindex(columns=fields)
+        if missing and dtypes:
+            df = apply_dtypes(df, {field: dtypes[field] for field in missing if field in dtypes})
+    if dtypes and measure_memory.is_set():
+        df.attrs['untyped_bytes'] = untyped
+    return df
+
+def shard_windows(start, end, shard):
+    # Split the report window into (lower, upper) bounds of a day or a week, newest first and open ended
+    step = timedelta(days=7 if shard == 'week' else 1)
+    bounds = []
+    upper = None
+    while end > start:
+        bounds.append((max(end - step, start), upper))
+        end -= step
+        upper = end
+    return bounds
+
+def window_params(filter, orderby, timefield, lower, upper=None):
+    # Query parameters for the records created after lower and up to upper, the endpoint filter and order are optional
+    parts = [filter] if filter else []
+    parts.append('{} gt "{}"'.format(timefield, lower))
+    if upper is not None:
+        parts.append('{} le "{}"'.format(timefield, upper))
+    params = {'filter': ' and '.join(parts)}
+    if orderby:
+        params['orderby'] = orderby
+    return params
+
+def window_pages(api, path, filter, orderby, pagesize, timefield, window, shard=None, workers=1, fields=None, pushdown=None):
+    # Yield the pages of records created after window, with shard set the day/week queries run in parallel
+    if shard is None:
+        yield from get_pages(api, path, window_params(filter, orderby, timefield, window), pagesize, fields, pushdown)
+        return
+    pages = queue.Queue()
+    endpoint = current_endpoint(path)
+    def fetch(bounds):
+        instrument.endpoint = endpoint
+        lower, upper = [bound.strftime(TIMEFORMAT) if bound is not None else None for bound in bounds]
+        for content in get_pages(api, path, window_params(filter, orderby, timefield, lower, upper), pagesize, fields, pushdown):
+            pages.put(content)
+    shards = shard_windows(datetime.strptime(window, TIMEFORMAT), datetime.now(), shard)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(fetch, bounds) for bounds in shards]
+        for future in futures:
+            future.add_done_callback(lambda future: pages.put(None))
+        remaining = len(futures)
+        while remaining:
+            content = pages.get()
+            if content is None:
+                remaining -= 1
+            else:
+                yield content
+        for future in futures:
+            future.result()
+
+def normalize_window(api, path, filter, orderby, pagesize, fields, timefield, window, shard=None, workers=1, dtypes=None, pushdown=None):
+    # Get the records created after window, with shard set the window is fetched as parallel day/week queries
+    if shard is None:
+        return normalize_pages(window_pages(api, path, filter, orderby, pagesize, timefield, window, fields=fields, pushdown=pushdown), fields, dtypes=dtypes)
+    keys = [key for key in ['id', 'createTime'] if key not in fields]
+    df = normalize_pages(window_pages(api, path, filter, orderby, pagesize, timefield, window, shard, workers, fields + keys, pushdown), fields + keys, dtypes=dtypes)
+    # Records on a shard boundary can be returned twice
+    if 'id' in df.columns:
+        df = df.drop_duplicates('id')
+    if 'createTime' in df.columns:
+        df = df.sort_values('createTime', ascending=False, kind='stable')
+    return df[[field for field in fields if field in df.columns]].reset_index(drop=True)
+
+def open_store(path):
+    # Open the local activity store, records are kept as raw JSON keyed by kind and activity id
+    db = sqlite3.connect(path, timeout=60)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS activities (kind TEXT, id TEXT, createTime TEXT, record TEXT, PRIMARY KEY (kind, id))')
+    db.execute('CREATE INDEX IF NOT EXISTS activities_createtime ON activities (kind, createTime)')
+    db.execute('CREATE TABLE IF NOT EXISTS sync (kind TEXT PRIMARY KEY, since TEXT, watermark TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS capacity (kind TEXT, system TEXT, name TEXT, day TEXT, total INTEGER, available INTEGER, usedlogical INTEGER, '
+               'PRIMARY KEY (kind, system, name, day))')
+    return db
+
+def sync_window(store, kind, api, path, filter, orderby, pagesize, fields, timefield, window, shard=None, workers=1, dtypes=None, pushdown=None):
+    # Append the records newer than the last sync watermark to the store, then read the report window back from it
+    # Whole records are stored so later runs can report other fields, only the pushdown filter is sent
+    db = open_store(store)
     try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    FIELDS1 = ["name", "type", "lastUpdated", "totalCapacityInBytes", "availableCapacityInBytes", "attributes.dayPreComp", "attributes.dayPostComp", "attributes.dayCompressionFactor", "attributes.usedLogicalCapacity", "attributes.serialNo", "_embedded.storageSystem.name", "retentionLockStatus", "retentionLockMode", "replicationTargets", "replicationSources", "createdAt", "attributes.groupId", "attributes.user"]
-    df10 = pd.json_normalize(response.json()['content'])
-    FIELDS2 = list(df10.keys())
-    FIELDS = []
-    for element in FIELDS1:
-        if element in FIELDS2:
-            FIELDS.append(element)
-    dd_df = df10[FIELDS]
-    return dd_df
-
-def get_license(uri, token):
-    # Get all the Licenses
-    suffixurl = "/licenses"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    params = {'pageSize': pageSize}
+        row = db.execute('SELECT since, watermark FROM sync WHERE kind = ?', (kind,)).fetchone()
+        since, watermark = window, None
+        if row is not None and row[0] <= window:
+            since, watermark = row
+        fetchfrom = window
+        if watermark:
+            # Read back a day before the watermark, the records already stored are replaced
+            fetchfrom = max(window, (pd.Timestamp(watermark) - SYNC_LOOKBACK).strftime(TIMEFORMAT))
+        synced = 0
+        for content in window_pages(api, path, filter, orderby, pagesize, timefield, fetchfrom, shard, workers, pushdown=pushdown):
+            rows = [(kind, record['id'], record.get('createTime'), json.dumps(record)) for record in content]
+            db.executemany('INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?)', rows)
+            db.commit()
+            watermark = max([watermark or ''] + [row[2] for row in rows if row[2]]) or None
+            synced += len(rows)
+        db.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?)', (kind, since, watermark))
+        db.commit()
+        print('Synced {} {} records since {} to {}'.format(synced, kind, fetchfrom, store))
+        cursor = db.execute('SELECT record FROM activities WHERE kind = ? AND createTime > ? ORDER BY createTime DESC', (kind, window))
+        def pages():
+            rows = cursor.fetchmany(pagesize)
+            while rows:
+                yield [json.loads(row[0]) for row in rows]
+                rows = cursor.fetchmany(pagesize)
+        return normalize_pages(pages(), fields, dtypes=dtypes)
+    finally:
+        db.close()
+
+def capacity_snapshot(ddmtrees, storage):
+    # Capacity of every Data Domain system and MTree today, taken from the records already collected
+    columns = ['Kind', 'System', 'Name', 'Day', 'Total', 'Available', 'UsedLogical']
+    day = pd.Timestamp.now(tz='UTC').strftime('%Y-%m-%d')
+    frames = []
+    if {'name', 'details.dataDomain.totalSize', 'details.dataDomain.totalUsed'} <= set(storage.columns):
+        total = pd.to_numeric(storage['details.dataDomain.totalSize'], errors='coerce')
+        used = pd.to_numeric(storage['details.dataDomain.totalUsed'], errors='coerce')
+        frames.append(pd.DataFrame({'Kind': 'Data Domain', 'System': storage['name'], 'Name': storage['name'], 'Day': day,
+                                    'Total': total, 'Available': total - used, 'UsedLogical': np.nan}))
+    if {'name', 'totalCapacityInBytes', 'availableCapacityInBytes'} <= set(ddmtrees.columns):
+        frames.append(pd.DataFrame({'Kind': 'MTree', 'System': ddmtrees.get('_embedded.storageSystem.name', ''), 'Name': ddmtrees['name'], 'Day': day,
+                                    'Total': ddmtrees['totalCapacityInBytes'], 'Available': ddmtrees['availableCapacityInBytes'],
+                                    'UsedLogical': ddmtrees.get('attributes.usedLogicalCapacity', np.nan)}))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat([frame.astype({'Total': float, 'Available': float, 'UsedLogical': float}) for frame in frames], ignore_index=True)
+    return df.dropna(subset=['Name', 'Total', 'Available'])[columns].fillna({'System': ''})
+
+def record_capacity(store, ddmtrees, storage, days=CAPACITY_DAYS):
+    # Keep today's capacity snapshot in the store and return the snapshots of the last days, only today's without a store
+    snapshot = capacity_snapshot(ddmtrees, storage)
+    if not store:
+        return snapshot
+    db = open_store(store)
     try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    li_df = pd.json_normalize(response.json()['content'], record_path=['licenseKeys'])
-    licdict = li_df.to_dict('records')
-    return licdict
-
-def get_srvdr(uri, token):
-    # Get PPDM Server DR Copies
-    suffixurl = "/server-disaster-recovery-backups"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
-    pageSize = '10000'
-    params = {'pageSize': pageSize}
+        rows = snapshot.astype(object).where(snapshot.notna(), None)
+        db.executemany('INSERT OR REPLACE INTO capacity (kind, system, name, day, total, available, usedlogical) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       rows.itertuples(index=False, name=None))
+        db.commit()
+        since = (pd.Timestamp.now(tz='UTC') - timedelta(days=days)).strftime('%Y-%m-%d')
+        history = pd.read_sql_query('SELECT kind AS Kind, system AS System, name AS Name, day AS Day, total AS Total, available AS Available, '
+                                    'usedlogical AS UsedLogical FROM capacity WHERE day >= ? ORDER BY day', db, params=(since,))
+    finally:
+        db.close()
+    print('Stored capacity of {} Data Domain systems and MTrees to {}'.format(len(snapshot), store))
+    return history.astype({'Total': float, 'Available': float, 'UsedLogical': float})
+
+# The PPDM endpoints collected, declared as data and all run by collect_endpoint:
+#   path        REST path under /api/v2
+#   filter      filter parameter of the query
+#   fields      dotted fields kept, all the fields when missing
+#   dtypes      types the fields are cast to
+#   rename      report column names of the fields
+#   record_path nested list of each record to flatten instead of the record
+#   timefield   the endpoint is windowed on this time field, ordered by orderby and synced to the store when there is one
+#   notnull     report columns a row must have
+#   pushdown    filter clause sent to the server for the notnull rows, dropped when the server rejects it
+#   records     return a list of dicts instead of a frame
+#   same        the records of another endpoint with the same query, fetched once
+#   sheet       report sheet the records are written to
+ENDPOINTS = {
+    'activities': {
+        'path': '/activities', 'sheet': 'Activities',
+        'filter': 'category eq "PROTECT" and classType in ("TASK") and state in ("COMPLETED")',
+        'orderby': 'createTime DESC', 'timefield': 'createTime',
+        'fields': ["protectionPolicy.name", "asset.name", "category", "date", "createTime", "updateTime", "duration", "state", "result.status", "name", "host.name", "stats.assetSizeInBytes", "stats.bytesTransferred", "stats.postCompBytes", "stats.dedupeRatio", "stats.reductionPercentage"],
+        'dtypes': {"protectionPolicy.name": 'category', "asset.name": 'category', "category": 'category', "createTime": 'datetime64[ns, UTC]', "updateTime": 'datetime64[ns, UTC]', "duration": 'Int64', "state": 'category', "result.status": 'category', "name": 'category', "host.name": 'category', "stats.assetSizeInBytes": 'Int64', "stats.bytesTransferred": 'Int64', "stats.postCompBytes": 'Int64', "stats.dedupeRatio": 'float32', "stats.reductionPercentage": 'float32'},
+        'rename': {"protectionPolicy.name": 'Policy Name', "asset.name": "Asset Name", "category": "Category", "date": "Date", "duration": "Duration (sec)", "state": "State", "result.status": "Status", "name": "Task", "host.name": "Client Name", "stats.assetSizeInBytes": "Asset Size", "stats.bytesTransferred": "Data Transferred", "stats.postCompBytes": "PostComp", "stats.dedupeRatio": "Dedupe Ratio", "stats.reductionPercentage": "Reduction %"},
+        'notnull': ['Policy Name'], 'pushdown': 'protectionPolicy.name ne null',
+    },
+    'jobgroups': {
+        'path': '/activities', 'sheet': 'JobGroups',
+        'filter': 'category eq "PROTECT" and classType in ("JOB_GROUP") and state in ("COMPLETED")',
+        'orderby': 'createTime DESC', 'timefield': 'createdTime',
+        'fields': ["protectionPolicy.name", "protectionPolicy.type", "stats.numberOfAssets", "stats.numberOfProtectedAssets", "category", "subcategory", "classType", "startTime", "endTime", "duration", "stats.bytesTransferredThroughput", "state", "result.status", "stats.assetSizeInBytes", "stats.preCompBytes", "stats.postCompBytes", "stats.bytesTransferred", "stats.dedupeRatio", "stats.reductionPercentage"],
+        'dtypes': {"protectionPolicy.name": 'category', "protectionPolicy.type": 'category', "stats.numberOfAssets": 'Int64', "stats.numberOfProtectedAssets": 'Int64', "category": 'category', "subcategory": 'category', "classType": 'category', "startTime": 'datetime64[ns, UTC]', "endTime": 'datetime64[ns, UTC]', "duration": 'Int64', "stats.bytesTransferredThroughput": 'Int64', "state": 'category', "result.status": 'category', "stats.assetSizeInBytes": 'Int64', "stats.preCompBytes": 'Int64', "stats.postCompBytes": 'Int64', "stats.bytesTransferred": 'Int64', "stats.dedupeRatio": 'float32', "stats.reductionPercentage": 'float32'},
+        'rename': {"protectionPolicy.name": 'Policy Name', "protectionPolicy.type": 'Policy Type', "stats.numberOfAssets": '# of Assets', "stats.numberOfProtectedAssets": '# of Protected Assets', "category": 'Category', "subcategory": 'SubCategory', "classType": 'JobType', "duration": 'Duration(sec)', "stats.bytesTransferredThroughput": 'Throughput(bytes)', "result.status": 'Status', "stats.assetSizeInBytes": 'Asset Size(b)', "stats.preCompBytes": 'PreComp(b)', "stats.postCompBytes": 'PostComp(b)', "stats.bytesTransferred": 'Bytes Transferred(b)', "stats.dedupeRatio": 'Dedupe Ratio', "stats.reductionPercentage": 'Reduction %'},
+    },
+    'policies': {
+        'path': '/protection-policies', 'sheet': 'Policies',
+        'filter': 'type eq "ACTIVE" and createdAt gt "2010-05-06T11:20:21.843Z"',
+        'fields': ["name", "assetType", "type", "enabled", "encrypted", "dataConsistency", "summary.numberOfAssets", "summary.totalAssetCapacity", "summary.totalAssetProtectionCapacity", "summary.lastExecutionStatus"],
+        'dtypes': {"assetType": 'category', "type": 'category', "dataConsistency": 'category', "summary.numberOfAssets": 'Int64', "summary.totalAssetCapacity": 'Int64', "summary.totalAssetProtectionCapacity": 'Int64', "summary.lastExecutionStatus": 'category'},
+        'rename': {"name": 'Name', "assetType": 'AssetType', "type": 'Type', "enabled": 'Enabled', "encrypted": 'Encrypted', "dataConsistency": 'Data Consistency', "summary.numberOfAssets": '# of Assets', "summary.totalAssetCapacity": 'TotalAssetCapacity(b)', "summary.totalAssetProtectionCapacity": 'TotalAssetProtectionCapacity(b)', "summary.lastExecutionStatus": 'Last Status'},
+    },
+    'assets': {
+        'path': '/assets', 'sheet': 'Assets',
+        'filter': 'createdAt gt "2010-05-06T11:20:21.843Z"',
+        'fields': ["id", "name", "type", "protectionStatus", "size", "subtype", "protectionPolicy.name", "protectionCapacity.size", "lastAvailableCopyTime", "details.k8s.inventorySourceName", "details.vm.guestOS", "details.vm.vcenterName", "details.vm.esxName", "details.database.clusterName"],
+        'dtypes': {"type": 'category', "protectionStatus": 'category', "size": 'Int64', "subtype": 'category', "protectionPolicy.name": 'category', "protectionCapacity.size": 'Int64', "lastAvailableCopyTime": 'datetime64[ns, UTC]', "details.k8s.inventorySourceName": 'category', "details.vm.guestOS": 'category', "details.vm.vcenterName": 'category', "details.vm.esxName": 'category', "details.database.clusterName": 'category'},
+        'rename': {"name": 'Name', "type": 'Type', "protectionStatus": 'Protection Status', "size": 'Size', "subtype": 'SubType', "protectionPolicy.name": 'PolicyName', "protectionCapacity.size": 'Protection Capacity(b)', "lastAvailableCopyTime": 'LastBackupCopy', "details.k8s.inventorySourceName": 'K8S Inv Source', "details.vm.guestOS": 'VM Guest OS', "details.vm.vcenterName": 'vCenterName', "details.vm.esxName": 'ESX Name', "details.database.clusterName": 'Database ClusterName'},
+    },
+    'invsources': {
+        'path': '/inventory-sources', 'sheet': 'InvSources',
+        'fields': ["name", "type", "version", "lastDiscoveryResult.status", "address"],
+    },
+    'storage': {
+        'path': '/storage-systems', 'sheet': 'Storage',
+        'fields': ["name", "type", "details.dataDomain.totalSize", "details.dataDomain.totalUsed", "capacityUtilization", "details.dataDomain.compressionFactor", "lastDiscoveryStatus", "lastDiscovered", "readiness", "details.dataDomain.version", "details.dataDomain.model", "details.dataDomain.serialNumber"],
+    },
+    'ddmtrees': {
+        'path': '/datadomain-mtrees', 'sheet': 'DDStorageUnits',
+        'fields': ["name", "type", "lastUpdated", "totalCapacityInBytes", "availableCapacityInBytes", "attributes.dayPreComp", "attributes.dayPostComp", "attributes.dayCompressionFactor", "attributes.usedLogicalCapacity", "attributes.serialNo", "_embedded.storageSystem.name", "retentionLockStatus", "retentionLockMode", "replicationTargets", "replicationSources", "createdAt", "attributes.groupId", "attributes.user"],
+        'dtypes': {"type": 'category', "totalCapacityInBytes": 'Int64', "availableCapacityInBytes": 'Int64', "attributes.dayPreComp": 'Int64', "attributes.dayPostComp": 'Int64', "attributes.dayCompressionFactor": 'float32', "attributes.usedLogicalCapacity": 'Int64', "_embedded.storageSystem.name": 'category'},
+    },
+    'protectioneng': {'path': '/protection-engines', 'sheet': 'ProtectionEngines'},
+    'appagents': {'same': 'protectioneng', 'sheet': 'AppAgents'},
+    'appconfig': {'path': '/configurations', 'sheet': 'PPDMServer', 'record_path': ['networks']},
+    'srvdrinfo': {
+        'path': '/server-disaster-recovery-backups', 'sheet': 'ServerDR',
+        'fields': ["hostname", "name", "version", "state", "creationTime", "backupConsistencyType", "components"],
+    },
+    'licinfo': {'path': '/licenses', 'record_path': ['licenseKeys'], 'records': True},
+}
+# Report sheets and the collected records they are written from
+SHEETS = {spec['sheet']: name for name, spec in ENDPOINTS.items() if 'sheet' in spec}
+
+def empty_records(name):
+    # The typed columns of an endpoint without rows, for a failed collection
+    spec = ENDPOINTS.get(name, {})
+    if 'same' in spec:
+        return empty_records(spec['same'])
+    fields = spec.get('fields') or []
+    df = apply_dtypes(pd.DataFrame(columns=fields), {field: dtype for field, dtype in (spec.get('dtypes') or {}).items() if field in fields})
+    df = df.rename(columns=spec.get('rename', {}))
+    return df.to_dict('records') if spec.get('records') else df
+
+def collect_endpoint(api, name, pagesize, window=None, shard=None, workers=1, store=None, ids=False):
+    # Collect one endpoint of ENDPOINTS, ids keeps the record id for the watch mode to merge polls
+    spec = ENDPOINTS[name]
+    fields, dtypes, pushdown = spec.get('fields'), spec.get('dtypes'), spec.get('pushdown')
+    if fields and ids and 'id' not in fields:
+        fields = fields + ['id']
+    if 'timefield' in spec:
+        if store:
+            df = sync_window(store, name, api, spec['path'], spec.get('filter'), spec.get('orderby'), pagesize, fields, spec['timefield'], window, shard, workers, dtypes, pushdown)
+        else:
+            df = normalize_window(api, spec['path'], spec.get('filter'), spec.get('orderby'), pagesize, fields, spec['timefield'], window, shard, workers, dtypes, pushdown)
+    else:
+        params = {'filter': spec['filter']} if 'filter' in spec else {}
+        df = normalize_pages(get_pages(api, spec['path'], params, pagesize, fields, pushdown), fields, spec.get('record_path'), dtypes)
+    df.rename(columns=spec.get('rename', {}), inplace=True)
+    for column in spec.get('notnull', []):
+        df = df[df[column].notnull()]
+    return df.to_dict('records') if spec.get('records') else df
+
+def frame_pages(df, size=10000):
+    # Split a frame into row chunks for the output writers
+    for start in range(0, max(len(df), 1), size):
+        yield df.iloc[start:start + size]
+
+def shortest_floats(df):
+    # float32 columns as the float64 of their shortest text, so a 1.3 ratio is not written as 1.2999999523
+    columns = [column for column in df.columns if df[column].dtype == 'float32']
+    if not columns:
+        return df
+    df = df.copy(deep=False)
+    for column in columns:
+        df[column] = df[column].astype(str).astype(float)
+    return df
+
+def cell_rows(df):
+    # Rows of plain Python values with NaN as None, nested values as text and timestamps as Excel serial dates
+    columns = []
+    df = shortest_floats(df)
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            if values.dt.tz is not None:
+                values = values.dt.tz_convert(None)
+            values = (values - EXCEL_EPOCH) / timedelta(days=1)
+        elif values.dtype == object:
+            values = values.map(lambda value: str(value) if isinstance(value, (list, dict)) else value)
+        columns.append(values.astype(object).where(values.notna(), None).tolist())
+    return zip(*columns)
+
+class ExcelOutput:
+    # Workbook written with xlsxwriter in constant_memory mode, each row is flushed to disk once the next one is written
+    # The sheets are written from the collected records, so only the workbook itself is kept out of memory
+    def __init__(self, path):
+        self.path = path
+        self.workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd'})
+        self.bold = self.workbook.add_format({'bold': True})
+        # Colors of 'Table Style Medium 2'
+        self.header = self.workbook.add_format({'bold': True, 'font_color': 'white', 'bg_color': '#4F81BD', 'bottom': 1, 'bottom_color': '#4F81BD'})
+        self.band = self.workbook.add_format({'bg_color': '#DCE6F1'})
+        self.datetime = self.workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss AM/PM'})
+
+    def write(self, sheet, pages, table=True, widths=None):
+        worksheet = self.workbook.add_worksheet(sheet)
+        columns, row = None, 0
+        for df in pages:
+            if columns is None:
+                columns = [str(column) for column in df.columns]
+                worksheet.write_row(0, 0, columns, self.header if table else self.bold)
+                # Column formats must be set before the rows are flushed, dates are formatted only here
+                if table:
+                    worksheet.set_column(0, len(columns) - 1, 12)
+                    worksheet.freeze_panes(1, 0)
+                for col_idx, dtype in enumerate(df.dtypes):
+                    if pd.api.types.is_datetime64_any_dtype(dtype):
+                        worksheet.set_column(col_idx, col_idx, 22, self.datetime)
+            for values in cell_rows(df):
+                row += 1
+                worksheet.write_row(row, 0, values)
+        if columns:
+            # add_table() is not available in constant_memory mode, a filtered header row and banded rows stand in for the table
+            if table and row:
+                worksheet.autofilter(0, 0, row, len(columns) - 1)
+                worksheet.conditional_format(1, 0, row, len(columns) - 1, {'type': 'formula', 'criteria': '=MOD(ROW(),2)=0', 'format': self.band})
+            for col_idx, width in enumerate(widths or []):
+                worksheet.set_column(col_idx, col_idx, width)
+        return row
+
+    def add_chart(self, options):
+        return self.workbook.add_chart(options)
+
+    def insert_chart(self, sheet, cell, chart):
+        self.workbook.get_worksheet_by_name(sheet).insert_chart(cell, chart)
+
+    def close(self):
+        self.workbook.close()
+
+class FileOutput:
+    # Directory with one streamed file per sheet, for analytics tools that do not read Excel
+    extension = None
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, sheet, pages, table=True, widths=None):
+        rows = 0
+        with self.open(os.path.join(self.path, '{}.{}'.format(sheet, self.extension))) as out:
+            for df in pages:
+                self.append(out, df, rows == 0)
+                rows += len(df)
+        return rows
+
+    def add_chart(self, options):
+        return None
+
+    def insert_chart(self, sheet, cell, chart):
+        pass
+
+    def close(self):
+        pass
+
+class CsvOutput(FileOutput):
+    extension = 'csv'
+
+    def open(self, path):
+        return open(path, 'w', newline='', encoding='utf-8')
+
+    def append(self, out, df, first):
+        shortest_floats(df).to_csv(out, header=first, index=False)
+
+class JsonlOutput(FileOutput):
+    extension = 'jsonl'
+
+    def open(self, path):
+        return open(path, 'w', encoding='utf-8')
+
+    def append(self, out, df, first):
+        if len(df):
+            out.write(shortest_floats(df).to_json(orient='records', lines=True, date_format='iso').rstrip('\n') + '\n')
+
+def import_pyarrow():
     try:
-        response = requests.get(uri, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as err:
-        print("The call {}{} failed with exception:{}".format(response.request.method, response.url, err))
-    if (response.status_code != 200):
-        raise Exception('Failed to query {}, code: {}, body: {}'.format(uri, response.status_code, response.text))
-    srvdr_df = pd.json_normalize(response.json()['content'])
-    FIELDS1 = ["hostname", "name", "version", "state", "creationTime", "backupConsistencyType", "components"]
-    FIELDS2 = list(srvdr_df.keys())
-    FIELDS = []
-    for element in FIELDS1:
-        if element in FIELDS2:
-            FIELDS.append(element)
-    srvdrb_df = srvdr_df[FIELDS]
-    srvdict = srvdrb_df.to_dict('records')
-    summary_dict['PPDM Hostname'] = srvdict[0]['hostname']
-    summary_dict['PPDM Version'] = srvdict[0]['version']
-    return srvdrb_df
-
-def chartxls(activities):
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('The parquet format needs pyarrow, install it with "pip install pyarrow"')
+    return pyarrow
+
+def text_columns(df):
+    # Parquet needs one type per column, free form object columns are written as text
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].map(lambda value: value if value is None or isinstance(value, str) else str(value))
+    return df
+
+class ParquetOutput(FileOutput):
+    extension = 'parquet'
+
+    def __init__(self, path):
+        self.pa = import_pyarrow()
+        super().__init__(path)
+
+    def open(self, path):
+        return ParquetFile(self.pa, path)
+
+    def append(self, out, df, first):
+        out.write(text_columns(df))
+
+class ParquetFile:
+    def __init__(self, pa, path):
+        self.pa, self.path, self.writer = pa, path, None
+
+    def write(self, df):
+        table = self.pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pa.parquet.ParquetWriter(self.path, table.schema)
+        elif table.schema != self.writer.schema:
+            table = table.cast(self.writer.schema, safe=False)
+        self.writer.write_table(table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.writer is not None:
+            self.writer.close()
+
+OUTPUTS = {'xlsx': ExcelOutput, 'csv': CsvOutput, 'jsonl': JsonlOutput, 'parquet': ParquetOutput}
+
+def open_output(format, path=None, name='ppdmdetails'):
+    # Excel writes one workbook, the other formats one file per sheet inside the path directory
+    if path is None:
+        path = name + '.xlsx' if format == 'xlsx' else name
+    return OUTPUTS[format](path)
+
+def chartxls(output, activities):
     # Create a chart
     activities['Date'] = pd.to_datetime(activities['createTime']).dt.date
     act_chartdf = activities[["Date", "Asset Size", "PostComp", "Dedupe Ratio"]]
@@ -350,10 +1063,11 @@ def chartxls(activities):
     act_chartdf["PostComp-GB"] = round(act_chartdf["PostComp"] / 1024 / 1024 / 1024, 2)
     act_chartdf["Date"] = act_chartdf["Date"]
     abc = act_chartdf.groupby('Date').agg({'BackupSize-GB':'sum', 'PostComp-GB': 'sum'})
-    abc.to_excel(writer, sheet_name='Chart')
-    workbook = writer.book
-    worksheet = writer.sheets['Chart']
-    chart = workbook.add_chart({'type': 'column'})
+    output.write('Chart', [abc.reset_index()], table=False)
+    chart = output.add_chart({'type': 'column'})
+    if chart is None:
+        print ("Written Chart information to {}".format(output.path))
+        return
     max_row = len(abc) + 1
     for i in range(len(['Date', 'BackupSize-GB'])):
         col = i + 1
@@ -367,11 +1081,15 @@ def chartxls(activities):
     chart.set_y_axis({'name': 'Size(GB)', 'major_gridlines': {'visible': False}})
     chart.set_legend({'position': 'top'})
     chart.set_size({'width': 900, 'height': 576})
-    worksheet.insert_chart('E2', chart)
-    print ("Created column chat to ppdmreport.xls")
+    output.insert_chart('Chart', 'E2', chart)
+    print ("Created column chat to {}".format(output.path))
 
-def summaryxls(assets, activities, jobgroups, ddmtrees, licinfo, rptdays):
-    # Write summary to excel sheet named summary
+def build_summary(assets, activities, jobgroups, ddmtrees, licinfo, srvdrinfo, rptdays):
+    # Summary values of one PPDM server, a fresh dict per server so fleet runs do not mix them
+    summary_dict = {'PPDM SERVER DETAILS': ''}
+    if len(srvdrinfo) and 'hostname' in srvdrinfo:
+        summary_dict['PPDM Hostname'] = srvdrinfo['hostname'].iloc[0]
+        summary_dict['PPDM Version'] = srvdrinfo['version'].iloc[0]
     if licinfo[0]['featureName'] == "POWERPROTECT SW TRIAL":
         summary_dict['License Type'] = licinfo[0]['featureName']
         summary_dict['Expiry Date'] = licinfo[0]['endDate']
@@ -380,7 +1098,9 @@ def summaryxls(assets, activities, jobgroups, ddmtrees, licinfo, rptdays):
         summary_dict['Expiry Date'] = licinfo[0]['licenseType']
     summary_dict['ASSET SUMMARY'] = ''
     atype = assets.value_counts('Type')
+    atype = atype[atype > 0]
     astatus = assets.value_counts('Protection Status')
+    astatus = astatus[astatus > 0]
     asize = assets['Size'].sum()
     fetb = assets['Protection Capacity(b)'].sum()
     summary_dict.update(atype.to_dict())
@@ -388,6 +1108,7 @@ def summaryxls(assets, activities, jobgroups, ddmtrees, licinfo, rptdays):
     summary_dict['Total Assets Size (GB)'] = round(asize/1024/1024/1024, 2)
     summary_dict['Protection Size (GB) - FETB'] = round(fetb/1024/1024/1024, 2)
     act_status = activities.value_counts('Status')
+    act_status = act_status[act_status > 0]
     act_assetsize = activities['Asset Size'].sum()
     act_bytestrans = activities['Data Transferred'].sum()
     act_postcomp = activities['PostComp'].sum()
@@ -402,92 +1123,955 @@ def summaryxls(assets, activities, jobgroups, ddmtrees, licinfo, rptdays):
     summary_dict['Backup Size (GB)'] = round(act_assetsize/1024/1024/1024, 2)
     summary_dict['Transferred Size (GB)'] = round(act_bytestrans/1024/1024/1024, 2)
     summary_dict['PostComp Size (GB)'] = round(act_postcomp/1024/1024/1024, 2)
-    summary_dict['Compression (< 1x) Clients'] = dedupeless1
-    summary_dict['Compression (< 3x) Clients'] = dedupeless3
-    summary_dict['Compression (> 3x) Clients'] = dedupegt3
+    summary_dict['Compression (< 1x) Backups'] = dedupeless1
+    summary_dict['Compression (< 3x) Backups'] = dedupeless3
+    summary_dict['Compression (> 3x) Backups'] = dedupegt3
     jbstats = jobgroups['Throughput(bytes)']
     lessth1mb = jbstats[jbstats < 1000000].count()
     lessth5mb = jbstats[jbstats < 5000000].count()
-    summary_dict['Backup Throughput (< 1MB) Clients'] = lessth1mb
-    summary_dict['Backup Throughput (< 5MB) Clients'] = lessth5mb
+    summary_dict['Backup Throughput (< 1MB) Job Groups'] = lessth1mb
+    summary_dict['Backup Throughput (< 5MB) Job Groups'] = lessth5mb
     summary_dict['DATA DOMAIN SUMMARY - LAST DAY'] = ''
     summary_dict['PreComp (GB)'] = round(mtree_precomp/1024/1024/1024, 2)
     summary_dict['PostComp (GB)'] = round(mtree_postcomp/1024/1024/1024, 2)
-    summdf = pd.DataFrame(list(summary_dict.items()), columns = ['Name','Value'])
-    summdf.to_excel(writer, sheet_name='Summary', index=False)
-    worksheet = writer.sheets['Summary']
-    (max_row, max_col) = summdf.shape
-    column_settings = [{'header': column} for column in summdf.columns]
-    worksheet.add_table(0, 0, max_row, max_col - 1, {'columns': column_settings, 'style': 'Table Style Medium 2'})
-    worksheet.set_column(0, max_col - 1, 12)
-    for column in summdf:
-        column_length = max(summdf[column].astype(str).map(len).max(), len(column))
-        col_idx = summdf.columns.get_loc(column)
-        writer.sheets['Summary'].set_column(col_idx, col_idx, column_length)
-    print ("Written Summary information to ppdmdetails.xls")
-
-def outxls(df_dict):
-    # Write output to excel
+    return summary_dict
+
+def fleet_totals(summaries):
+    # Add up the numeric summary values of all the servers, text values such as the version are left blank
+    totals = {}
+    for summary in summaries.values():
+        for name, value in summary.items():
+            if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool):
+                totals[name] = round((totals.get(name) or 0) + value, 2)
+            else:
+                totals.setdefault(name, '')
+    return totals
+
+def summary_frame(summaries):
+    # One value column per summary, the rows keep the order the names first appear in
+    names = list(dict.fromkeys(name for summary in summaries.values() for name in summary))
+    columns = {'Name': names}
+    for column, summary in summaries.items():
+        columns[column] = [summary.get(name, '') for name in names]
+    return pd.DataFrame(columns)
+
+def summaryxls(output, summdf):
+    # Write summary to excel sheet named summary
+    widths = [max(summdf[column].astype(str).map(len).max(), len(column)) for column in summdf]
+    output.write('Summary', [summdf], widths=widths)
+    print ("Written Summary information to {}".format(output.path))
+
+def analytics_keys(df, column):
+    # Fleet reports are grouped per server as well
+    return ['Server', column] if 'Server' in df.columns else [column]
+
+def group_codes(df, keys):
+    # Group number of every row from the category codes of the keys, much cheaper than a groupby ngroup
+    codes = np.zeros(len(df), dtype=np.int64)
+    for key in keys:
+        values = df[key] if isinstance(df[key].dtype, pd.CategoricalDtype) else df[key].astype('category')
+        codes = codes * len(values.cat.categories) + values.cat.codes.to_numpy()
+    return codes
+
+def failure_streaks(activities):
+    # Runs, failures and consecutive failure streaks per client and per policy, the current streak ends with the latest backup
+    # Every result other than the SUCCESS_STATUSES is a failure
+    frames = []
+    for scope, column in [('Client', 'Client Name'), ('Policy', 'Policy Name')]:
+        keys = analytics_keys(activities, column)
+        df = activities[keys + ['createTime', 'Status']].dropna(subset=[column, 'createTime'])
+        group = group_codes(df, keys)
+        created = df['createTime'].dt.tz_convert(None).to_numpy(dtype='datetime64[ns]').view(np.int64)
+        # Activities arrive newest first, reversed they only need a stable sort by group, otherwise sort by group and time
+        order = len(group) - 1 - np.argsort(group[::-1], kind='stable')
+        if not np.all((np.diff(created[order]) >= 0) | (np.diff(group[order]) != 0)):
+            order = np.lexsort((created, group))
+        df, group = df.iloc[order], group[order]
+        failed = ~df['Status'].isin(SUCCESS_STATUSES).to_numpy(dtype=bool)
+        # A streak restarts at every success and at the first backup of every client or policy,
+        # the failures counted before the latest restart are carried forward and taken off the running count
+        first = np.r_[True, group[1:] != group[:-1]][:len(group)]
+        counted = np.cumsum(failed)
+        restart = np.maximum.accumulate(np.where(first | ~failed, counted - failed, 0))
+        streak = counted - restart
+        recent = (df['createTime'] >= df['createTime'].max() - timedelta(days=7)).to_numpy()
+        df = df.assign(Failed=failed, Streak=streak, Recent=recent, RecentFailed=recent & failed,
+                       LastFailure=df['createTime'].where(failed), LastSuccess=df['createTime'].where(~failed))
+        summary = df.groupby(group, sort=False).agg(
+            Runs=('Failed', 'size'), Failures=('Failed', 'sum'), RecentRuns=('Recent', 'sum'), RecentFailures=('RecentFailed', 'sum'),
+            Current=('Streak', 'last'), Longest=('Streak', 'max'), LastFailure=('LastFailure', 'max'), LastSuccess=('LastSuccess', 'max'))
+        summary = pd.concat([df[keys].iloc[np.flatnonzero(first)].reset_index(drop=True), summary.reset_index(drop=True)], axis=1)
+        summary['Success Rate %'] = ((1 - summary['Failures'] / summary['Runs']) * 100).round(1)
+        summary['Success Rate % (7 days)'] = ((1 - summary['RecentFailures'] / summary['RecentRuns'].where(summary['RecentRuns'] > 0)) * 100).round(1)
+        summary = summary.rename(columns={column: 'Name', 'Current': 'Current Streak', 'Longest': 'Longest Streak',
+                                          'LastFailure': 'Last Failure', 'LastSuccess': 'Last Success'})
+        summary.insert(0, 'Scope', scope)
+        frames.append(summary[['Scope'] + keys[:-1] + ['Name', 'Runs', 'Failures', 'Success Rate %', 'Success Rate % (7 days)',
+                                                       'Current Streak', 'Longest Streak', 'Last Failure', 'Last Success']])
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values(['Current Streak', 'Failures'], ascending=False, kind='stable').reset_index(drop=True)
+
+def success_trend(activities, days=7):
+    # Daily success rate of every policy next to its rolling success rate over the last days
+    keys = analytics_keys(activities, 'Policy Name')
+    df = activities[keys + ['createTime', 'Status']].dropna(subset=keys + ['createTime'])
+    df = df.assign(Date=df['createTime'].dt.floor('D'), Runs=1, Successes=df['Status'].isin(SUCCESS_STATUSES).astype(int))
+    daily = df.groupby(keys + ['Date'], observed=True).agg(Runs=('Runs', 'sum'), Successes=('Successes', 'sum')).reset_index()
+    if daily.empty:
+        return pd.DataFrame(columns=keys + ['Date', 'Runs', 'Successes', 'Success Rate %', 'Rolling {} Day Success Rate %'.format(days)])
+    # Every policy gets a row for every day, so a rolling window of rows is a window of days
+    dates = pd.DataFrame({'Date': pd.date_range(daily['Date'].min(), daily['Date'].max(), freq='D')})
+    grid = daily[keys].drop_duplicates().merge(dates, how='cross')
+    daily = grid.merge(daily, how='left', on=keys + ['Date']).fillna({'Runs': 0, 'Successes': 0})
+    daily = daily.sort_values(keys + ['Date'], kind='stable').reset_index(drop=True)
+    totals = daily.groupby(keys, observed=True, sort=False)[['Runs', 'Successes']].cumsum()
+    position = np.arange(len(daily)) % len(dates)
+    window = totals - totals.shift(days).fillna(0).mul(position >= days, axis=0)
+    daily['Success Rate %'] = (daily['Successes'] / daily['Runs'].where(daily['Runs'] > 0) * 100).round(1)
+    daily['Rolling {} Day Success Rate %'.format(days)] = (window['Successes'] / window['Runs'].where(window['Runs'] > 0) * 100).round(1)
+    daily[['Runs', 'Successes']] = daily[['Runs', 'Successes']].astype(int)
+    return daily[keys + ['Date', 'Runs', 'Successes', 'Success Rate %', 'Rolling {} Day Success Rate %'.format(days)]]
+
+def throughput_percentiles(activities, jobgroups):
+    # p50/p95/p99 backup throughput per client from the protection tasks and per policy from the job groups, slowest first
+    frames = []
+    # PPDM reports the duration of an activity in milliseconds
+    seconds = activities['Duration (sec)'].to_numpy(dtype=float, na_value=np.nan) / 1000
+    transferred = activities['Data Transferred'].to_numpy(dtype=float, na_value=np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clients = activities[analytics_keys(activities, 'Client Name')].assign(MBps=np.where(seconds > 0, transferred / seconds, np.nan) / 1048576)
+    policies = jobgroups[analytics_keys(jobgroups, 'Policy Name')].assign(MBps=jobgroups['Throughput(bytes)'].to_numpy(dtype=float, na_value=np.nan) / 1048576)
+    for scope, df in [('Client', clients), ('Policy', policies)]:
+        keys = list(df.columns[:-1])
+        grouped = df.dropna().groupby(keys, observed=True)['MBps']
+        summary = grouped.quantile([0.5, 0.95, 0.99]).unstack().reindex(columns=[0.5, 0.95, 0.99])
+        summary.columns = ['p50 (MB/s)', 'p95 (MB/s)', 'p99 (MB/s)']
+        summary.insert(0, 'Runs', grouped.size())
+        summary['Mean (MB/s)'] = grouped.mean()
+        summary = summary.round(2).reset_index().rename(columns={keys[-1]: 'Name'})
+        summary.insert(0, 'Scope', scope)
+        frames.append(summary)
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values(['Scope', 'p50 (MB/s)'], kind='stable').reset_index(drop=True)
+
+def dedupe_drift(activities):
+    # Dedupe ratio of every client in the older and the newer half of the report window and its trend per day, largest drop first
+    keys = analytics_keys(activities, 'Client Name')
+    df = activities[keys + ['createTime']].assign(Ratio=activities['Dedupe Ratio'].astype(float)).dropna()
+    day = (df['createTime'] - df['createTime'].min()).dt.total_seconds().to_numpy() / 86400
+    recent = day >= day.max() / 2 if len(day) else day > 0
+    df = df.assign(Day=day, DaySq=day * day, DayRatio=day * df['Ratio'], Earlier=df['Ratio'].where(~recent), Recent=df['Ratio'].where(recent))
+    summary = df.groupby(keys, observed=True).agg(Runs=('Ratio', 'size'), Mean=('Ratio', 'mean'), Earlier=('Earlier', 'mean'), Recent=('Recent', 'mean'),
+                                                  Day=('Day', 'sum'), DaySq=('DaySq', 'sum'), Ratio=('Ratio', 'sum'), DayRatio=('DayRatio', 'sum'))
+    # Least squares slope of the ratio over time, from the per client sums
+    runs = summary['Runs']
+    denominator = runs * summary['DaySq'] - summary['Day'] ** 2
+    summary['Trend (x / day)'] = ((runs * summary['DayRatio'] - summary['Day'] * summary['Ratio']) / denominator.where(denominator > 1e-9)).round(4)
+    summary['Drift %'] = ((summary['Recent'] - summary['Earlier']) / summary['Earlier'].where(summary['Earlier'] > 0) * 100).round(1)
+    summary = summary.rename(columns={'Mean': 'Mean Dedupe', 'Earlier': 'Earlier Dedupe', 'Recent': 'Recent Dedupe'}).round(2)
+    summary = summary.reset_index().rename(columns={keys[-1]: 'Client Name'})
+    columns = keys + ['Runs', 'Mean Dedupe', 'Earlier Dedupe', 'Recent Dedupe', 'Drift %', 'Trend (x / day)']
+    return summary[columns].sort_values('Drift %', kind='stable').reset_index(drop=True)
+
+def backup_window(jobgroups):
+    # How many other job groups, of any policy including its own, run at the same time as the job groups of each policy
+    keys = analytics_keys(jobgroups, 'Policy Name')
+    df = jobgroups[keys + ['startTime', 'endTime']].dropna()
+    start = df['startTime'].dt.tz_convert(None).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    end = np.maximum(df['endTime'].dt.tz_convert(None).to_numpy(dtype='datetime64[ns]').astype(np.int64), start + 1)
+    if 'Server' in df.columns and len(df):
+        # Shift every server to its own stretch of time so only job groups of the same server overlap
+        offset = df['Server'].cat.codes.to_numpy().astype(np.int64) * (end.max() - start.min() + 1)
+        start, end = start - start.min() + offset, end - start.min() + offset
+    # Job groups overlapping [start, end) started before its end and did not end before its start, less itself
+    concurrent = np.searchsorted(np.sort(start), end, 'left') - np.searchsorted(np.sort(end), start, 'right') - 1
+    df = df.assign(Minutes=(end - start) / 6e10, Hour=df['startTime'].dt.hour, Concurrent=concurrent, Overlapping=concurrent > 0)
+    summary = df.groupby(keys, observed=True).agg(Runs=('Minutes', 'size'), Minutes=('Minutes', 'mean'), Hour=('Hour', 'median'),
+                                                  Concurrent=('Concurrent', 'mean'), Peak=('Concurrent', 'max'), Overlapping=('Overlapping', 'mean'))
+    summary['Overlapping'] *= 100
+    summary = summary.round(1).reset_index().rename(columns={'Runs': 'Job Groups', 'Minutes': 'Avg Duration (min)', 'Hour': 'Median Start Hour (UTC)',
+                                                             'Concurrent': 'Avg Concurrent Job Groups', 'Peak': 'Max Concurrent Job Groups', 'Overlapping': 'Overlapping %'})
+    return summary.sort_values('Avg Concurrent Job Groups', ascending=False, kind='stable').reset_index(drop=True)
+
+def analyticsxls(output, activities, jobgroups):
+    # Write the chronic failure, success trend, throughput, dedupe drift and backup window sheets
+    sheets = [('ChronicFailures', failure_streaks, (activities,)), ('SuccessTrend', success_trend, (activities,)),
+              ('Throughput', throughput_percentiles, (activities, jobgroups)), ('DedupeDrift', dedupe_drift, (activities,)),
+              ('BackupWindow', backup_window, (jobgroups,))]
+    for sheet, func, frames in sheets:
+        try:
+            df = func(*frames)
+        except Exception as err:
+            print('Failed to build {} information: {}'.format(sheet, err))
+            continue
+        output.write(sheet, frame_pages(df))
+        print("Written '{}' information to {}".format(sheet, output.path))
+
+def capacity_forecast(history):
+    # Growth of the used capacity of every Data Domain system and MTree by one least squares fit over all the series at once
+    keys = (['Server'] if 'Server' in history.columns else []) + ['Kind', 'System', 'Name']
+    history = history.dropna(subset=['Total', 'Available'])
+    group, _ = pd.factorize(group_codes(history, keys))
+    count = np.bincount(group)
+    day = (pd.to_datetime(history['Day'], format='%Y-%m-%d') - pd.Timestamp('2000-01-01')).dt.days.to_numpy(dtype=float)
+    used = (history['Total'] - history['Available']).to_numpy(dtype=float) / 1024 / 1024 / 1024
+    sumday, sumused = np.bincount(group, day), np.bincount(group, used)
+    sumdaysq, sumdayused = np.bincount(group, day * day), np.bincount(group, day * used)
+    denominator = count * sumdaysq - sumday ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = np.where(denominator > 0, (count * sumdayused - sumday * sumused) / denominator, np.nan)
+    # The latest snapshot of every series
+    order = np.lexsort((day, group))
+    last = order[np.r_[group[order][1:] != group[order][:-1], True][:len(order)]]
+    latest, latest_group = history.iloc[last], group[last]
+    df = latest[keys].reset_index(drop=True)
+    gb = 1024 * 1024 * 1024
+    df['Total (GB)'] = (latest['Total'].to_numpy() / gb).round(2)
+    df['Used (GB)'] = ((latest['Total'] - latest['Available']).to_numpy() / gb).round(2)
+    df['Available (GB)'] = (latest['Available'].to_numpy() / gb).round(2)
+    df['Used %'] = (df['Used (GB)'] / df['Total (GB)'].where(df['Total (GB)'] > 0) * 100).round(1)
+    df['Used Logical (GB)'] = (latest['UsedLogical'].to_numpy() / gb).round(2)
+    df['Snapshots'] = count[latest_group]
+    df['Growth (GB/day)'] = growth[latest_group].round(2)
+    rate = df['Growth (GB/day)'].where(df['Growth (GB/day)'] > 0)
+    # A system already past full is due today, not a negative number of days ago
+    df['Days to Full'] = (df['Available (GB)'].clip(lower=0) / rate).round(0)
+    # Forecasts past a century are left without a date, they would not fit a timestamp anyway
+    df['Full Date'] = pd.to_datetime(latest['Day'].to_numpy()) + pd.to_timedelta(df['Days to Full'].where(df['Days to Full'] <= 36500), unit='D')
+    return df.sort_values(['Days to Full', 'Used %'], ascending=[True, False], kind='stable').reset_index(drop=True)
+
+def capacityxls(output, history):
+    # Write the capacity forecast and the daily used capacity of the Data Domain systems with a line chart
+    df = capacity_forecast(history)
+    output.write('Capacity', [df])
+    systems = history[history['Kind'] == 'Data Domain']
+    names = ['Server', 'Name'] if 'Server' in systems.columns else ['Name']
+    series = systems.assign(Series=systems[names].astype(str).agg(' '.join, axis=1) if len(systems) else '',
+                            Used=(systems['Total'] - systems['Available']) / 1024 / 1024 / 1024)
+    trend = series.pivot_table(index='Day', columns='Series', values='Used', aggfunc='last').round(2)
+    trend.index = pd.to_datetime(trend.index)
+    trend = trend.rename_axis(columns=None).reset_index().rename(columns={'Day': 'Date'})
+    output.write('CapacityTrend', [trend], table=False)
+    chart = output.add_chart({'type': 'line'})
+    if chart is not None and len(trend):
+        for col in range(1, len(trend.columns)):
+            chart.add_series({
+            'name':       ['CapacityTrend', 0, col],
+            'categories': ['CapacityTrend', 1, 0, len(trend), 0],
+            'values':     ['CapacityTrend', 1, col, len(trend), col],
+            'marker':     {'type': 'circle'},
+            })
+        chart.set_x_axis({'name': 'Date', 'date_axis': True, 'num_format': 'yyyy-mm-dd'})
+        chart.set_y_axis({'name': 'Used (GB)', 'major_gridlines': {'visible': False}})
+        chart.set_legend({'position': 'top'})
+        chart.set_size({'width': 900, 'height': 576})
+        output.insert_chart('Capacity', 'A{}'.format(len(df) + 4), chart)
+    print("Written Capacity information to {}".format(output.path))
+
+def outxls(output, df_dict, pagesize=10000):
+    # Write output sheet by sheet, each frame is streamed in pages of rows
     for sheet, df in  df_dict.items():
-        df.to_excel(writer, sheet_name = sheet, startrow=1, header=False, index=False)
-        workbook = writer.book
-        worksheet = writer.sheets[sheet]
-        (max_row, max_col) = df.shape
-        column_settings = [{'header': column} for column in df.columns]
-        worksheet.add_table(0, 0, max_row, max_col - 1, {'columns': column_settings, 'style': 'Table Style Medium 2'})
-        worksheet.set_column(0, max_col - 1, 12)
-        print ("Written '{}' information to ppdmdetails.xls".format(sheet))
+        output.write(sheet, frame_pages(df, pagesize))
+        print ("Written '{}' information to {}".format(sheet, output.path))
     # writer.sheets['Summary'].activate()
-    writer.close()
+    output.close()
+
+def current_endpoint(default=None):
+    return getattr(instrument, 'endpoint', default)
+
+def memory_status():
+    # Current and peak resident memory in MB, None where /proc is not available
+    try:
+        with open('/proc/self/status') as status:
+            values = dict(line.split(':', 1) for line in status if ':' in line)
+        return int(values['VmRSS'].split()[0]) / 1024, int(values['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def reset_peak_memory():
+    # Restart the peak RSS of the process on Linux, elsewhere the peak covers the whole run
+    try:
+        with open('/proc/self/clear_refs', 'w') as refs:
+            refs.write('5')
+    except OSError:
+        pass
+
+@contextmanager
+def stage(name):
+    # Time one stage of the run and track its memory, optionally under cProfile, ppdmbench.py reads stage_timings
+    reset_peak_memory()
+    rss_before, _ = memory_status()
+    profiler = cProfile.Profile() if name in cprofile_stages else None
+    if profiler is not None:
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_stages[name])
+            print('Written cProfile of the {} stage to {}'.format(name, cprofile_stages[name]))
+        rss_after, peak = memory_status()
+        stage_timings[name] = elapsed
+        stage_log.append({'stage': name, 'seconds': elapsed, 'rss_before_mb': rss_before, 'rss_after_mb': rss_after, 'peak_rss_mb': peak})
+
+def write_profile(path, timings):
+    # Write the stages, endpoints and API requests of the run to a JSON or CSV file
+    stages = pd.DataFrame(stage_log, columns=['stage', 'seconds', 'rss_before_mb', 'rss_after_mb', 'peak_rss_mb'])
+    endpoints = pd.DataFrame(timings, columns=['endpoint', 'status', 'seconds'])
+    requests_df = pd.DataFrame(request_log, columns=['endpoint', 'path', 'status', 'attempts', 'cache', 'projection', 'bytes', 'records', 'seconds', 'parse_seconds'])
+    perendpoint = requests_df.groupby('endpoint').agg(requests=('path', 'size'), attempts=('attempts', 'sum'), bytes=('bytes', 'sum'), records=('records', 'sum'),
+                                                      request_seconds=('seconds', 'sum'), max_request_seconds=('seconds', 'max'), parse_seconds=('parse_seconds', 'sum'))
+    normalized = pd.DataFrame(normalize_log, columns=['endpoint', 'pages', 'normalize_seconds']).groupby('endpoint').sum()
+    endpoints = endpoints.merge(perendpoint, how='left', left_on='endpoint', right_index=True)
+    endpoints = endpoints.merge(normalized, how='left', left_on='endpoint', right_index=True)
+    if path.lower().endswith('.csv'):
+        frames = [df.assign(section=section) for section, df in [('stage', stages), ('endpoint', endpoints), ('request', requests_df)]]
+        pd.concat(frames, ignore_index=True).to_csv(path, index=False)
+    else:
+        profile = {'version': __version__, 'finished': datetime.now().isoformat()}
+        for section, df in [('stages', stages), ('endpoints', endpoints), ('requests', requests_df)]:
+            profile[section] = json.loads(df.to_json(orient='records'))
+        with open(path, 'w') as out:
+            json.dump(profile, out, indent=2)
+    print('Written run profile to {}'.format(path))
+
+def collect(jobs, workers, server=None):
+    # Run the independent collectors concurrently, a failed endpoint returns an empty frame, a job given as a name shares that job's records
+    def run(name, func, args):
+        instrument.endpoint = name if server is None else '{}/{}'.format(server, name)
+        start = time.perf_counter()
+        try:
+            result, status = func(*args), 'OK'
+        except Exception as err:
+            print('Failed to collect {}: {}'.format(name, err))
+            result, status = empty_records(name), 'FAILED'
+        return result, (name, status, time.perf_counter() - start)
+    results, timings = {}, []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {name: executor.submit(run, name, *job) for name, job in jobs.items() if not isinstance(job, str)}
+        for name, future in futures.items():
+            results[name], timing = future.result()
+            timings.append(timing)
+    for name, same in jobs.items():
+        if isinstance(same, str):
+            # A shallow copy, the fleet mode adds a column to each frame
+            results[name] = results[same].copy(deep=False)
+    return results, timings
+
+def print_timings(timings):
+    # Print the per-endpoint collection times, megabytes received and where the fields were selected, slowest first
+    received, projection = {}, {}
+    for entry in request_log:
+        received[entry['endpoint']] = received.get(entry['endpoint'], 0) + entry['bytes']
+        if entry['projection']:
+            projection.setdefault(entry['endpoint'], set()).add(entry['projection'])
+    print('{:<20} {:<8} {:>10} {:>10} {:<10}'.format('Endpoint', 'Status', 'Time (s)', 'MB', 'Fields'))
+    for name, status, elapsed in sorted(timings, key=lambda t: t[2], reverse=True):
+        print('{:<20} {:<8} {:>10.2f} {:>10.2f} {:<10}'.format(name, status, elapsed, received.get(name, 0) / 1024 / 1024, ','.join(sorted(projection.get(name, ['-'])))))
 
-def logout(ppdm, user, uri, token):
-    suffixurl = "/logout"
-    uri += suffixurl
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer {}'.format(token)}
+def print_memory(data):
+    # Print the memory of the typed frames next to the memory they took as json_normalize output
+    print('{:<20} {:>12} {:>12}'.format('Records', 'Before (MB)', 'After (MB)'))
+    for name, df in data.items():
+        if isinstance(df, pd.DataFrame) and 'untyped_bytes' in df.attrs:
+            after = df.memory_usage(deep=True).sum()
+            print('{:<20} {:>12.2f} {:>12.2f}'.format(name, df.attrs['untyped_bytes'] / 1024 / 1024, after / 1024 / 1024))
+
+def logout(api):
     try:
-        response = requests.post(uri, headers=headers, verify=False)
-        response.raise_for_status()
+        response = api.post('/logout')
     except requests.exceptions.RequestException as err:
-            print("The call {} {} failed with exception:{}".format(response.request.method, response.url, err))
+        raise Exception('Logout failed for user: {}, error: {}'.format(api.user, err))
     if (response.status_code != 204):
         raise Exception('Logout failed for user: {}, code: {}, body: {}'.format(
-            user, response.status_code, response.text))
-    print('Logout for user: {} from PPDM: {}'.format(user, ppdm))
+            api.user, response.status_code, response.text))
+    print('Logout for user: {} from PPDM: {}'.format(api.user, api.ppdm))
 
 
-def main():
-    port = "8443"
+def server_uri(server, port, http=False):
     apiendpoint = "/api/v2"
-    args = get_args()
-    ppdm, user, password, rptdays = args.server, args.user, args.password, args.rptdays
-    uri = "https://{}:{}{}".format(ppdm, port, apiendpoint)
-    token = authenticate(ppdm, user, password, uri)
-    gettime = datetime.now() - timedelta(days = int(rptdays))
-    window = gettime.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-    appconfig = get_appliance_config(uri, token) 
-    policies = get_policies(uri, token)
-    assets = get_assets(uri, token)
-    invsources = get_inv_src(uri, token)
-    storage = get_storage(uri, token)
-    protectioneng = get_protection_eng(uri, token)
-    appagents = get_app_agents(uri, token)
-    activities = get_activities(uri, token, window)
-    jobgroups = get_jobgroups(uri, token, window)
-    ddmtrees = get_ddmtrees(uri, token)
-    licinfo = get_license(uri, token)
+    return "{}://{}:{}{}".format('http' if http else 'https', server, port, apiendpoint)
+
+def collection_jobs(api, window, args, store=None):
+    # The collectors of one PPDM server and their arguments
+    jobs = {}
+    for name, spec in ENDPOINTS.items():
+        if 'same' in spec:
+            jobs[name] = spec['same']
+        elif 'timefield' in spec:
+            jobs[name] = (collect_endpoint, (api, name, args.pagesize, window, args.shard, args.workers, store))
+        else:
+            jobs[name] = (collect_endpoint, (api, name, args.pagesize))
+    return jobs
+
+def read_inventory(path, user, password, port):
+    # Read the fleet from a CSV file with a server,user,password,port[,name] header or a JSON list of such objects
+    # Each server is known by its name, by default the host, with the port added when it is not the default one
+    with open(path, newline='') as inv:
+        if path.lower().endswith('.json'):
+            rows = json.load(inv)
+        else:
+            rows = list(csv.DictReader(inv))
+    servers, names = [], set()
+    for row in rows:
+        if not (row.get('server') or '').strip():
+            continue
+        server, serverport = row['server'].strip(), str(row.get('port') or port)
+        name = (row.get('name') or '').strip() or (server if serverport == str(port) else '{}:{}'.format(server, serverport))
+        if name in names:
+            raise Exception('PPDM server {} is listed twice in {}, give the rows different ports or names'.format(name, path))
+        names.add(name)
+        servers.append({'name': name, 'server': server, 'user': row.get('user') or user, 'password': row.get('password') or password,
+                        'port': serverport})
+    return servers
+
+def server_store(store, name):
+    # Activity ids and sync watermarks are per server, so each fleet server keeps its own store file
+    if not store:
+        return None
+    root, ext = os.path.splitext(store)
+    return '{}-{}{}'.format(root, re.sub(r'[^\w.-]', '-', name), ext)
+
+def collect_server(entry, args, window, limiter, cache=None):
+    # Login to one fleet server and collect it, a failure is returned so the other servers carry on
+    server, name = entry['server'], entry['name']
+    api = PpdmApi(server, entry['user'], entry['password'], server_uri(server, entry['port'], args.http), args.workers, args.timeout, args.retries, limiter, cache, not args.no_projection)
+    result = {'data': None, 'timings': [], 'error': None}
+    start = time.perf_counter()
     try:
-        srvdrinfo = get_srvdr(uri, token)
-    except:
-        srvdrinfo = pd.DataFrame()
-    summaryxls(assets, activities, jobgroups, ddmtrees, licinfo, rptdays)
+        api.login()
+    except requests.exceptions.RequestException as err:
+        print('Login failed for user: {} to PPDM: {}, error: {}'.format(api.user, name, err))
+        result['error'] = 'Login failed: {}'.format(err)
+        result['seconds'] = time.perf_counter() - start
+        return result
+    print('Logged in with user: {} to PPDM: {}'.format(api.user, name))
+    result['data'], result['timings'] = collect(collection_jobs(api, window, args, server_store(args.store, name)), args.workers, name)
+    result['seconds'] = time.perf_counter() - start
     try:
-        chartxls(activities)
-    except:
-        pass
-    df_dict = {'Activities': activities, 'JobGroups': jobgroups, 'Policies': policies, 'Assets': assets, 'InvSources': invsources, 'Storage': storage, 'DDStorageUnits': ddmtrees, 'ProtectionEngines': protectioneng, 'AppAgents': appagents, 'PPDMServer': appconfig, 'ServerDR': srvdrinfo}
-    outxls(df_dict)
+        logout(api)
+    except Exception as err:
+        print(err)
+    return result
+
+def collect_fleet(servers, args, window, cache=None):
+    # Collect the fleet servers in parallel, each with its own session, all of them share one cap on API calls in flight
+    limiter = threading.BoundedSemaphore(max(1, args.max_calls))
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.fleet_workers)) as executor:
+        futures = {entry['name']: executor.submit(collect_server, entry, args, window, limiter, cache) for entry in servers}
+        for server, future in futures.items():
+            try:
+                results[server] = future.result()
+            except Exception as err:
+                print('Failed to collect PPDM: {}: {}'.format(server, err))
+                results[server] = {'data': None, 'timings': [], 'error': str(err), 'seconds': 0}
+    return results
+
+def tag_server(df, server):
+    # Add the source server as the first column, a category costs one byte per row
+    df.insert(0, 'Server', pd.Categorical([server] * len(df)))
+    return df
+
+def fleet_frames(results):
+    # Concatenate the records of every server, each row tagged with the server it came from
+    frames = {}
+    for name in SHEETS.values():
+        parts = [tag_server(result['data'][name], server) for server, result in results.items()
+                 if result['data'] is not None and isinstance(result['data'][name], pd.DataFrame)]
+        parts = [df for df in parts if len(df)] or parts[:1]
+        dtypes = {column: 'category' for df in parts for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)}
+        frames[name] = concat_pages(parts, dtypes) if parts else empty_records(name)
+    return frames
+
+def run_fleet(args, output, window, cache=None):
+    # Collect every server of the inventory and write one report with fleet totals and per server breakdowns
+    servers = read_inventory(args.inventory, args.user, args.password, args.port)
+    print('Collecting {} PPDM servers from {}'.format(len(servers), args.inventory))
+    with stage('collection'):
+        results = collect_fleet(servers, args, window, cache)
+    summaries, status, timings = {}, [], []
+    for server, result in results.items():
+        failed = [name for name, state, _ in result['timings'] if state != 'OK']
+        status.append({'Server': server, 'Status': 'FAILED' if result['error'] else 'OK', 'Failed Endpoints': ', '.join(failed),
+                       'Error': result['error'] or '', 'Collection (sec)': round(result['seconds'], 2)})
+        timings += [('{}/{}'.format(server, name), state, elapsed) for name, state, elapsed in result['timings']]
+        data = result['data']
+        if data is None:
+            continue
+        if args.memreport:
+            print('PPDM: {}'.format(server))
+            print_memory(data)
+        try:
+            summaries[server] = build_summary(data['assets'], data['activities'], data['jobgroups'], data['ddmtrees'], data['licinfo'], data['srvdrinfo'], args.rptdays)
+        except Exception as err:
+            print('Failed to build Summary information of PPDM: {}: {}'.format(server, err))
+    frames = fleet_frames(results)
+    summdf = None
+    with stage('summaryxls'):
+        try:
+            summdf = summary_frame(dict({'Fleet Total': fleet_totals(summaries)}, **summaries))
+            summaryxls(output, summdf)
+        except Exception as err:
+            print('Failed to write Summary information: {}'.format(err))
+        output.write('Servers', [pd.DataFrame(status)])
+        print("Written Servers information to {}".format(output.path))
+    with stage('chartxls'):
+        try:
+            chartxls(output, frames['activities'])
+        except:
+            pass
+    with stage('analytics'):
+        analyticsxls(output, frames['activities'], frames['jobgroups'])
+    with stage('capacity'):
+        try:
+            histories = [tag_server(record_capacity(server_store(args.store, server), result['data']['ddmtrees'], result['data']['storage']), server)
+                         for server, result in results.items() if result['data'] is not None]
+            capacityxls(output, pd.concat(histories, ignore_index=True) if histories else capacity_snapshot(pd.DataFrame(), pd.DataFrame()))
+        except Exception as err:
+            print('Failed to write Capacity information: {}'.format(err))
+    with stage('outxls'):
+        outxls(output, {sheet: frames[name] for sheet, name in SHEETS.items()})
+    print("All the data written to the file")
+    if args.snapshot:
+        with stage('snapshot'):
+            write_snapshot(args.snapshot, frames, summdf)
+    failed = [row['Server'] for row in status if row['Status'] != 'OK']
+    if failed:
+        print('Failed to collect {} of {} PPDM servers: {}'.format(len(failed), len(status), ', '.join(failed)))
+    return timings
+
+# Records compared between two snapshots: kind, join keys, name column and the columns whose changes are reported
+COMPARE = {
+    'assets': ('Asset', ['id'], 'Name', ['Protection Status', 'PolicyName']),
+    'policies': ('Policy', ['Name'], 'Name', ['AssetType', 'Type', 'Enabled', 'Encrypted', 'Data Consistency', '# of Assets']),
+}
+
+def write_snapshot(root, frames, summdf=None):
+    # Keep the collected records and the summary of this run as parquet files in a directory of root named by the time
+    import_pyarrow()
+    path = os.path.join(root, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(path, exist_ok=True)
+    if summdf is not None:
+        frames = dict(frames, summary=summdf)
+    for name, df in frames.items():
+        if isinstance(df, pd.DataFrame):
+            text_columns(df).to_parquet(os.path.join(path, '{}.parquet'.format(name)), index=False)
+    print('Written snapshot to {}'.format(path))
+    return path
+
+def read_snapshot(path, names):
+    # Records of a snapshot directory, an empty frame for the ones it does not have
+    import_pyarrow()
+    if not os.path.isdir(path):
+        raise Exception('Snapshot {} not found'.format(path))
+    frames = {}
+    for name in names:
+        file = os.path.join(path, '{}.parquet'.format(name))
+        frames[name] = pd.read_parquet(file) if os.path.exists(file) else pd.DataFrame()
+    return frames
+
+def change_rows(kind, change, part, server, key, name, field='', old=None, new=None):
+    # Rows of the Changes sheet for one kind of change
+    return pd.DataFrame({'Kind': kind, 'Change': change, 'Server': part[server].to_numpy() if server else '',
+                         'Key': part[key].to_numpy(), 'Name': name.to_numpy(), 'Field': field,
+                         'Old': old.to_numpy() if old is not None else pd.NA, 'New': new.to_numpy() if new is not None else pd.NA},
+                        index=pd.RangeIndex(len(part)))
+
+def diff_records(kind, old, new, keys, label, fields):
+    # Records added, removed and changed between two snapshots, matched by a join on the keys
+    server = 'Server' if 'Server' in old.columns and 'Server' in new.columns else None
+    keys = ([server] if server else []) + keys
+    if not set(keys + [label]) <= set(old.columns) & set(new.columns):
+        return []
+    fields = [field for field in fields if field in old.columns and field in new.columns and field not in keys + [label]]
+    columns = list(dict.fromkeys(keys + [label] + fields))
+    # Compared as text, categories of the two snapshots differ and nullable values compare as NA
+    merged = old[columns].astype('string').merge(new[columns].astype('string'), on=keys, how='outer', suffixes=(' old', ' new'), indicator=True)
+    if label in keys:
+        name = merged[label]
+    else:
+        name = merged['{} new'.format(label)].fillna(merged['{} old'.format(label)])
+    key = keys[-1]
+    frames = []
+    for change, side in [('Added', 'right_only'), ('Removed', 'left_only')]:
+        rows = merged['_merge'] == side
+        frames.append(change_rows(kind, change, merged[rows], server, key, name[rows]))
+    both = merged['_merge'] == 'both'
+    for field in fields:
+        before, after = merged['{} old'.format(field)], merged['{} new'.format(field)]
+        rows = both & (before.fillna('') != after.fillna(''))
+        frames.append(change_rows(kind, 'Changed', merged[rows], server, key, name[rows], field, before[rows], after[rows]))
+    return frames
+
+def diff_summary(old, new):
+    # Summary figures that changed between two snapshots, per server in a fleet snapshot
+    if 'Name' not in old.columns or 'Name' not in new.columns:
+        return []
+    before = old.melt(id_vars='Name', var_name='Column', value_name='Figure').astype('string')
+    after = new.melt(id_vars='Name', var_name='Column', value_name='Figure').astype('string')
+    merged = before.merge(after, on=['Name', 'Column'], how='outer', suffixes=(' old', ' new'))
+    rows = merged['Figure old'].fillna('') != merged['Figure new'].fillna('')
+    merged = merged[rows]
+    return [pd.DataFrame({'Kind': 'Summary', 'Change': 'Changed', 'Server': merged['Column'].where(merged['Column'] != 'Value', '').to_numpy(),
+                          'Key': merged['Name'].to_numpy(), 'Name': merged['Name'].to_numpy(), 'Field': '',
+                          'Old': merged['Figure old'].to_numpy(), 'New': merged['Figure new'].to_numpy()})]
+
+def compare_snapshots(oldpath, newpath):
+    # Changes sheet of two snapshots: assets and policies added, removed or changed and the shifts of the summary figures
+    names = list(COMPARE) + ['summary']
+    old, new = read_snapshot(oldpath, names), read_snapshot(newpath, names)
+    frames = []
+    for name, (kind, keys, label, fields) in COMPARE.items():
+        frames += diff_records(kind, old[name], new[name], keys, label, fields)
+    frames += diff_summary(old['summary'], new['summary'])
+    columns = ['Kind', 'Change', 'Server', 'Key', 'Name', 'Field', 'Old', 'New']
+    changes = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    if not changes['Server'].astype(bool).any():
+        changes = changes.drop(columns='Server')
+    before = pd.to_numeric(changes['Old'], errors='coerce')
+    changes['Delta'] = pd.to_numeric(changes['New'], errors='coerce') - before
+    changes['Delta %'] = (changes['Delta'] / before.where(before != 0) * 100).round(2)
+    return changes
+
+def comparexls(output, oldpath, newpath):
+    changes = compare_snapshots(oldpath, newpath)
+    output.write('Changes', frame_pages(changes))
+    counts = changes.groupby(['Kind', 'Change'], sort=False).size()
+    print('Written {} changes between {} and {} to {}: {}'.format(len(changes), oldpath, newpath, output.path,
+                                                              ', '.join('{} {} {}'.format(count, kind, change.lower()) for (kind, change), count in counts.items())))
+    output.close()
+
+def write_report(output, data, rptdays, store=None):
+    # Write the summary, chart, analytics, capacity and data sheets of one server
+    assets, activities, jobgroups, ddmtrees = data['assets'], data['activities'], data['jobgroups'], data['ddmtrees']
+    licinfo, srvdrinfo = data['licinfo'], data['srvdrinfo']
+    summdf = None
+    with stage('summaryxls'):
+        try:
+            summdf = summary_frame({'Value': build_summary(assets, activities, jobgroups, ddmtrees, licinfo, srvdrinfo, rptdays)})
+            summaryxls(output, summdf)
+        except Exception as err:
+            print('Failed to write Summary information: {}'.format(err))
+    with stage('chartxls'):
+        try:
+            chartxls(output, activities)
+        except:
+            pass
+    with stage('analytics'):
+        analyticsxls(output, activities, jobgroups)
+    with stage('capacity'):
+        try:
+            capacityxls(output, record_capacity(store, ddmtrees, data['storage']))
+        except Exception as err:
+            print('Failed to write Capacity information: {}'.format(err))
+    df_dict = {sheet: data[name] for sheet, name in SHEETS.items()}
+    with stage('outxls'):
+        outxls(output, df_dict)
     print("All the data written to the file")
-    logout(ppdm, user, uri, token)
+    return summdf
+
+def metric_series(name, labels):
+    # One Prometheus series name with its labels, label values escaped as the text format requires
+    escaped = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels.items()]
+    return '{}{{{}}}'.format(name, ','.join(escaped))
+
+def window_metrics(activities, jobgroups, server):
+    # Summary metrics that add up over activities and job groups, the watch mode adds the new ones and takes off the expired ones
+    metrics = {}
+    def add(name, value, **labels):
+        key = metric_series(name, dict(server=server, **labels))
+        metrics[key] = metrics.get(key, 0) + float(value)
+    if len(activities):
+        for status, count in activities['Status'].value_counts().items():
+            add('ppdm_activities', count, status=status)
+        add('ppdm_activity_bytes', activities['Asset Size'].sum(), kind='asset')
+        add('ppdm_activity_bytes', activities['Data Transferred'].sum(), kind='transferred')
+        add('ppdm_activity_bytes', activities['PostComp'].sum(), kind='postcomp')
+        ratio = activities['Dedupe Ratio']
+        add('ppdm_activities_by_compression', (ratio < 1).sum(), ratio='lt1')
+        add('ppdm_activities_by_compression', (ratio < 3).sum(), ratio='lt3')
+        add('ppdm_activities_by_compression', (ratio > 3).sum(), ratio='gt3')
+    if len(jobgroups):
+        for status, count in jobgroups['Status'].value_counts().items():
+            add('ppdm_jobgroups', count, status=status)
+        throughput = jobgroups['Throughput(bytes)']
+        add('ppdm_jobgroups_by_throughput', (throughput < 1000000).sum(), throughput='lt1mb')
+        add('ppdm_jobgroups_by_throughput', (throughput < 5000000).sum(), throughput='lt5mb')
+    return metrics
+
+def inventory_metrics(data, server):
+    # Summary metrics of the inventory endpoints, replaced on every inventory refresh
+    metrics = {}
+    def add(name, value, **labels):
+        metrics[metric_series(name, dict(server=server, **labels))] = float(value)
+    assets, ddmtrees, licinfo, srvdrinfo = data['assets'], data['ddmtrees'], data['licinfo'], data['srvdrinfo']
+    if len(assets):
+        for assettype, count in assets['Type'].value_counts().items():
+            add('ppdm_assets', count, type=assettype)
+        for status, count in assets['Protection Status'].value_counts().items():
+            add('ppdm_assets_by_protection', count, status=status)
+        add('ppdm_asset_bytes', assets['Size'].sum(), kind='size')
+        add('ppdm_asset_bytes', assets['Protection Capacity(b)'].sum(), kind='protected')
+    if len(ddmtrees):
+        add('ppdm_mtree_day_bytes', ddmtrees['attributes.dayPreComp'].astype(float).sum(), kind='precomp')
+        add('ppdm_mtree_day_bytes', ddmtrees['attributes.dayPostComp'].astype(float).sum(), kind='postcomp')
+    if len(srvdrinfo) and 'hostname' in srvdrinfo and isinstance(licinfo, list) and licinfo:
+        add('ppdm_info', 1, hostname=srvdrinfo['hostname'].iloc[0], version=srvdrinfo['version'].iloc[0], license=licinfo[0].get('featureName', ''))
+    return metrics
+
+METRIC_HELP = {
+    'ppdm_activities': ('gauge', 'Protection tasks in the report period by status'),
+    'ppdm_activity_bytes': ('gauge', 'Asset, transferred and post compression bytes of the protection tasks in the report period'),
+    'ppdm_activities_by_compression': ('gauge', 'Protection tasks in the report period by dedupe ratio'),
+    'ppdm_jobgroups': ('gauge', 'Job groups in the report period by status'),
+    'ppdm_jobgroups_by_throughput': ('gauge', 'Job groups in the report period by throughput'),
+    'ppdm_assets': ('gauge', 'Assets by type'),
+    'ppdm_assets_by_protection': ('gauge', 'Assets by protection status'),
+    'ppdm_asset_bytes': ('gauge', 'Size and protection capacity of the assets'),
+    'ppdm_mtree_day_bytes': ('gauge', 'Pre and post compression bytes written to the DD MTrees in the last day'),
+    'ppdm_info': ('gauge', 'PPDM hostname, version and license'),
+    'ppdm_watermark_timestamp_seconds': ('gauge', 'Create time of the newest activity'),
+    'ppdm_last_poll_timestamp_seconds': ('gauge', 'Time of the last successful poll'),
+    'ppdm_poll_errors_total': ('counter', 'Failed polls and inventory refreshes'),
+    'ppdm_api_requests_total': ('counter', 'API requests made by the watch mode'),
+    'ppdm_api_bytes_total': ('counter', 'Response bytes received by the watch mode'),
+}
+
+class Watcher:
+    # Records and summary metrics of one PPDM server kept up to date in memory, for the metrics endpoint and on demand reports
+    def __init__(self, api, args):
+        self.api, self.args = api, args
+        self.lock = threading.Lock()
+        self.report_lock = threading.Lock()
+        self.data, self.window, self.inventory = {}, {}, {}
+        self.counters = {'ppdm_poll_errors_total': 0.0, 'ppdm_api_requests_total': 0.0, 'ppdm_api_bytes_total': 0.0}
+        self.polled = None
+
+    def period(self):
+        return pd.Timestamp.now(tz='UTC') - timedelta(days=int(self.args.rptdays))
+
+    def load(self):
+        # Collect everything once, the activities and job groups keep their ids so later polls can be merged
+        window = self.period().tz_convert(None).strftime(TIMEFORMAT)
+        jobs = collection_jobs(self.api, window, self.args)
+        for name in ('activities', 'jobgroups'):
+            jobs[name] = (collect_endpoint, (self.api, name, self.args.pagesize, window, self.args.shard, self.args.workers, None, True))
+        data, _ = collect(jobs, self.args.workers)
+        with self.lock:
+            self.data = data
+            self.window = window_metrics(data['activities'], data['jobgroups'], self.api.ppdm)
+            self.inventory = inventory_metrics(data, self.api.ppdm)
+            self.polled = time.time()
+        self.count_requests()
+
+    def refresh_inventory(self):
+        # Collect the inventory endpoints again, the response cache spares the slowly changing ones
+        jobs = {name: job for name, job in collection_jobs(self.api, None, self.args).items() if 'timefield' not in ENDPOINTS[name]}
+        data, timings = collect(jobs, self.args.workers)
+        failed = [name for name, status, _ in timings if status != 'OK']
+        with self.lock:
+            # Keep the last good records of an endpoint that failed this time
+            self.data.update({name: df for name, df in data.items() if name not in failed})
+            self.inventory = inventory_metrics(self.data, self.api.ppdm)
+            self.counters['ppdm_poll_errors_total'] += len(failed)
+        self.count_requests()
+
+    def merge(self, name, timefield, lookback):
+        # Fetch the records created since lookback before the newest one, add the new ids and drop the records older than the report period
+        current = self.data.get(name)
+        if not isinstance(current, pd.DataFrame) or not {'id', timefield} <= set(current.columns) or current.empty:
+            # The first load was empty or failed, so collect the whole period again
+            delta = collect_endpoint(self.api, name, self.args.pagesize, self.period().tz_convert(None).strftime(TIMEFORMAT), ids=True)
+            return delta.reset_index(drop=True), delta, delta.iloc[0:0]
+        lower = max(self.period(), current[timefield].max() - lookback)
+        delta = collect_endpoint(self.api, name, self.args.pagesize, lower.tz_convert(None).strftime(TIMEFORMAT), ids=True)
+        new = delta[~delta['id'].isin(current['id'])]
+        expired = current[timefield] <= self.period()
+        merged = concat_pages([new, current[~expired]], {column: 'category' for column in current.columns if isinstance(current[column].dtype, pd.CategoricalDtype)})
+        return merged.reset_index(drop=True), new, current[expired]
+
+    def poll(self, lookback):
+        activities, newactivities, oldactivities = self.merge('activities', 'createTime', lookback)
+        jobgroups, newjobgroups, oldjobgroups = self.merge('jobgroups', 'startTime', lookback)
+        added = window_metrics(newactivities, newjobgroups, self.api.ppdm)
+        removed = window_metrics(oldactivities, oldjobgroups, self.api.ppdm)
+        with self.lock:
+            self.data['activities'], self.data['jobgroups'] = activities, jobgroups
+            for key in set(added) | set(removed):
+                self.window[key] = self.window.get(key, 0) + added.get(key, 0) - removed.get(key, 0)
+            self.polled = time.time()
+        self.count_requests()
+        print('Polled {} new activities and {} new job groups, {} and {} expired'.format(len(newactivities), len(newjobgroups), len(oldactivities), len(oldjobgroups)))
+
+    def count_requests(self):
+        # Fold the request log into counters, a resident process must not keep every request
+        with self.lock:
+            self.counters['ppdm_api_requests_total'] += len(request_log)
+            self.counters['ppdm_api_bytes_total'] += sum(entry['bytes'] for entry in request_log)
+        del request_log[:], normalize_log[:], stage_log[:]
+
+    def failed(self, err):
+        print('Failed to poll PPDM: {}: {}'.format(self.api.ppdm, err))
+        with self.lock:
+            self.counters['ppdm_poll_errors_total'] += 1
+
+    def exposition(self):
+        # All the metrics in the Prometheus text format
+        with self.lock:
+            activities = self.data.get('activities')
+            watermark = activities['createTime'].max() if activities is not None and len(activities) else pd.NaT
+            series = dict(self.window, **self.inventory)
+            server = {'server': self.api.ppdm}
+            for name, value in self.counters.items():
+                series[metric_series(name, server)] = value
+            series[metric_series('ppdm_last_poll_timestamp_seconds', server)] = self.polled or 0
+            if not pd.isna(watermark):
+                series[metric_series('ppdm_watermark_timestamp_seconds', server)] = watermark.timestamp()
+        lines, current = [], None
+        for key in sorted(series):
+            name = key.split('{', 1)[0]
+            if name != current:
+                kind, text = METRIC_HELP.get(name, ('gauge', name))
+                lines += ['# HELP {} {}'.format(name, text), '# TYPE {} {}'.format(name, kind)]
+                current = name
+            value = series[key]
+            lines.append('{} {}'.format(key, int(value) if float(value).is_integer() else value))
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        # Write the report from the records in memory, without calling the API
+        with self.report_lock:
+            with self.lock:
+                data = dict(self.data)
+            # The ids were only kept to merge the polls
+            for name in ('activities', 'jobgroups'):
+                data[name] = data[name].drop(columns='id', errors='ignore')
+            output = open_output(self.args.format, self.args.output)
+            write_report(output, data, self.args.rptdays, self.args.store)
+            del stage_log[:]
+        return output.path
+
+def serve_metrics(watcher, host, port):
+    # Serve /metrics in the Prometheus text format and /report to write the report from memory
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, code, body, ctype='text/plain; charset=utf-8'):
+            data = body.encode()
+            self.send_response(code)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == '/metrics':
+                return self.reply(200, watcher.exposition(), 'text/plain; version=0.0.4; charset=utf-8')
+            if path == '/report':
+                try:
+                    return self.reply(200, 'Written report to {}\n'.format(watcher.report()))
+                except Exception as err:
+                    return self.reply(500, 'Failed to write the report: {}\n'.format(err))
+            self.reply(404, 'Not found\n')
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Serving metrics on http://{}:{}/metrics and reports on /report'.format(host, port))
+    return server
+
+def run_watch(api, args):
+    # Keep the session open, poll new activities every watch seconds and the inventory every watch-inventory seconds
+    watcher = Watcher(api, args)
+    with stage('collection'):
+        watcher.load()
+    server = serve_metrics(watcher, args.metrics_host, args.metrics_port)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    inventory = time.monotonic() + args.watch_inventory
+    try:
+        while True:
+            time.sleep(args.watch)
+            try:
+                if time.monotonic() >= inventory:
+                    # Look a whole day back with the inventory, for long backups that completed since their start
+                    watcher.poll(SYNC_LOOKBACK)
+                    watcher.refresh_inventory()
+                    inventory = time.monotonic() + args.watch_inventory
+                else:
+                    watcher.poll(timedelta(seconds=args.watch_overlap))
+            except Exception as err:
+                watcher.failed(err)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        logout(api)
+
+def setup_libraries():
+    # Load the libraries the worker threads share on this thread, the first access of a lazy module is not thread safe before Python 3.12
+    for module in (np, pd, urllib3, requests):
+        getattr(module, '__file__')
+    pd.options.mode.chained_assignment = None
+    urllib3.disable_warnings()
+
+def main():
+    args = get_args()
+    setup_libraries()
+    rptdays = args.rptdays
+    if args.watch:
+        cache = open_cache(args)
+        api = PpdmApi(args.server, args.user, args.password, server_uri(args.server, args.port, args.http), args.workers, args.timeout, args.retries, threading.BoundedSemaphore(max(1, args.workers)), cache, not args.no_projection)
+        authenticate(api)
+        run_watch(api, args)
+        return
+    # Changes get their own default name so a compare does not overwrite the last report
+    output = open_output(args.format, args.output, 'ppdmchanges' if args.compare else 'ppdmdetails')
+    for name in args.cprofile or []:
+        cprofile_stages[name] = '{}.{}.prof'.format(os.path.splitext(args.profile or 'ppdmat')[0], name)
+    if args.compare:
+        with stage('compare'):
+            comparexls(output, *args.compare)
+        if args.profile:
+            write_profile(args.profile, [])
+        return
+    gettime = datetime.now() - timedelta(days = int(rptdays))
+    window = gettime.strftime(TIMEFORMAT)
+    if args.memreport:
+        measure_memory.set()
+    cache = open_cache(args)
+    if args.inventory:
+        timings = run_fleet(args, output, window, cache)
+        print_timings(timings)
+        print_cache(cache)
+        if args.profile:
+            write_profile(args.profile, timings)
+        return
+    ppdm, user, password, port = args.server, args.user, args.password, args.port
+    api = PpdmApi(ppdm, user, password, server_uri(ppdm, port, args.http), args.workers, args.timeout, args.retries, threading.BoundedSemaphore(max(1, args.workers)), cache, not args.no_projection)
+    with stage('login'):
+        authenticate(api)
+    jobs = collection_jobs(api, window, args, args.store)
+    with stage('collection'):
+        data, timings = collect(jobs, args.workers)
+    if args.memreport:
+        print_memory(data)
+    summdf = write_report(output, data, rptdays, args.store)
+    if args.snapshot:
+        with stage('snapshot'):
+            write_snapshot(args.snapshot, {name: data[name] for name in SHEETS.values()}, summdf)
+    with stage('logout'):
+        logout(api)
+    print_timings(timings)
+    print_cache(cache)
+    if args.profile:
+        write_profile(args.profile, timings)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of ppdmat.py against the ppdmmock.py server - Github @ rjainoje
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['collection', 'summaryxls', 'chartxls', 'analytics', 'capacity', 'outxls']
+
+def get_args():
+    # Get command line args from the user
+    parser = argparse.ArgumentParser(
+        description='Benchmark ppdmat.py against a local mock PPDM server')
+    parser.add_argument('-sc', '--scales', required=False, action='store', default='1000,100000',
+                        help='Comma separated numbers of activities to benchmark')
+    parser.add_argument('-n', '--runs', required=False, action='store', type=int, default=1,
+                        help='Runs per scale, the fastest run is kept')
+    parser.add_argument('-l', '--latency', required=False, action='store', type=float, default=0,
+                        help='Latency of the mock server in milliseconds')
+    parser.add_argument('-e', '--error-rate', required=False, action='store', type=float, default=0,
+                        help='Fraction of mock server requests answered with 503')
+    parser.add_argument('-a', '--ppdmat-args', required=False, action='store', default='',
+                        help='Extra arguments passed to ppdmat.py, e.g. "-sh day -w 8"')
+    parser.add_argument('-fs', '--field-savings', required=False, action='store_true',
+                        help='Also run every scale with -np and print the bytes the field projection saved per endpoint')
+    parser.add_argument('-o', '--results', required=False, action='store', default='ppdmbench.json',
+                        help='File the results are written to')
+    parser.add_argument('-b', '--baseline', required=False, action='store',
+                        help='Results of an earlier version to compare with')
+    parser.add_argument('-tol', '--tolerance', required=False, action='store', type=float, default=0.25,
+                        help='Allowed slowdown against the baseline, 0.25 is 25%%')
+    parser.add_argument('--child', required=False, action='store', nargs=argparse.REMAINDER,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    return args
+
+def peak_rss_mb():
+    # Peak resident memory of this process, resource is not available on Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024, 1)
+
+def child(argv):
+    # Run ppdmat.main() in this process and write wall time, peak RSS and stage timings to the result file
+    result, argv = argv[0], argv[1:]
+    sys.path.insert(0, HERE)
+    import ppdmat
+    sys.argv = ['ppdmat.py'] + argv
+    start = time.perf_counter()
+    ppdmat.main()
+    wall = time.perf_counter() - start
+    received = {}
+    for entry in ppdmat.request_log:
+        received[entry['endpoint']] = received.get(entry['endpoint'], 0) + entry['bytes']
+    with open(result, 'w') as out:
+        json.dump({'wall': wall, 'peak_rss_mb': peak_rss_mb(), 'stages': dict(ppdmat.stage_timings), 'bytes': received}, out)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_mock(activities, latency, error_rate):
+    port = free_port()
+    command = [sys.executable, os.path.join(HERE, 'ppdmmock.py'), '--port', str(port), '-a', str(activities),
+               '-l', str(latency), '-e', str(error_rate)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    # The server prints one line once it is listening
+    server.stdout.readline()
+    return server, port
+
+def run_once(port, workdir, extra):
+    result = os.path.join(workdir, 'result.json')
+    command = [sys.executable, os.path.abspath(__file__), '--child', result, '-s', '127.0.0.1', '--port', str(port), '--http',
+               '-pwd', 'ppdmbench', '-o', os.path.join(workdir, 'ppdmdetails.xlsx')] + extra
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(result) as out:
+        return json.load(out)
+
+def bench(scale, args):
+    server, port = start_mock(scale, args.latency, args.error_rate)
+    try:
+        runs = []
+        for run in range(args.runs):
+            with tempfile.TemporaryDirectory() as workdir:
+                runs.append(run_once(port, workdir, args.ppdmat_args.split()))
+        if args.field_savings:
+            with tempfile.TemporaryDirectory() as workdir:
+                whole = run_once(port, workdir, args.ppdmat_args.split() + ['-np'])
+    finally:
+        server.terminate()
+        server.wait()
+    best = min(runs, key=lambda run: run['wall'])
+    best['activities'] = scale
+    if args.field_savings:
+        best['unprojected_bytes'] = whole['bytes']
+    return best
+
+def print_results(results):
+    print('{:>10} {:>10} {:>10} {:>12} {:>11} {:>10} {:>8} {:>14}'.format(
+        'Activities', 'Wall (s)', 'RSS (MB)', 'Collect (s)', 'Summary (s)', 'Chart (s)', 'Out (s)', 'us / activity'))
+    for result in results:
+        stages = result['stages']
+        print('{:>10} {:>10.2f} {:>10} {:>12.2f} {:>11.2f} {:>10.2f} {:>8.2f} {:>14.1f}'.format(
+            result['activities'], result['wall'], result['peak_rss_mb'] or '-', stages.get('collection', 0), stages.get('summaryxls', 0),
+            stages.get('chartxls', 0), stages.get('outxls', 0), result['wall'] / result['activities'] * 1000000))
+
+def print_savings(results):
+    # Bytes received per endpoint with and without the server side field projection
+    print('{:>10} {:<16} {:>12} {:>12} {:>8}'.format('Activities', 'Endpoint', 'Whole (MB)', 'Fields (MB)', 'Saved'))
+    for result in results:
+        for endpoint, whole in sorted(result.get('unprojected_bytes', {}).items(), key=lambda item: item[1], reverse=True):
+            projected = result['bytes'].get(endpoint, 0)
+            print('{:>10} {:<16} {:>12.2f} {:>12.2f} {:>7.0f}%'.format(result['activities'], endpoint, whole / 1024 / 1024, projected / 1024 / 1024,
+                                                                    (1 - projected / whole) * 100 if whole else 0))
+
+def regressions(results, baseline, tolerance):
+    # Wall time, peak RSS and stages slower than the baseline of the same scale by more than tolerance
+    found = []
+    previous = {result['activities']: result for result in baseline}
+    for result in results:
+        before = previous.get(result['activities'])
+        if before is None:
+            continue
+        metrics = [('wall', result['wall'], before['wall']), ('peak_rss_mb', result['peak_rss_mb'], before['peak_rss_mb'])]
+        metrics += [(name, result['stages'].get(name), before['stages'].get(name)) for name in STAGES]
+        for name, now, then in metrics:
+            # Sub 50ms timings are noise
+            if now is not None and then and now > then * (1 + tolerance) and now - then > 0.05:
+                found.append('{} activities: {} {:.2f} -> {:.2f}'.format(result['activities'], name, then, now))
+    return found
+
+def main():
+    args = get_args()
+    if args.child is not None:
+        child(args.child)
+        return
+    results = [bench(int(scale), args) for scale in args.scales.split(',')]
+    print_results(results)
+    if args.field_savings:
+        print_savings(results)
+    with open(args.results, 'w') as out:
+        json.dump(results, out, indent=2)
+    print('Written benchmark results to {}'.format(args.results))
+    if args.baseline:
+        with open(args.baseline) as out:
+            found = regressions(results, json.load(out), args.tolerance)
+        for line in found:
+            print('REGRESSION {}'.format(line))
+        if found:
+            sys.exit(1)
+        print('No regression against {}'.format(args.baseline))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# Offline stand-in for the PPDM REST API used by ppdmat.py and ppdmbench.py - Github @ rjainoje
+
+import argparse
+import json
+import math
+import random
+import re
+import ssl
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TIMEFORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+TOKEN = 'ppdmmock-token'
+STATUSES = ['OK', 'OK', 'OK', 'OK', 'OK', 'OK', 'OK', 'OK_WITH_ERRORS', 'FAILED', 'CANCELED']
+ASSET_TYPES = ['VMWARE_VIRTUAL_MACHINE', 'VMWARE_VIRTUAL_MACHINE', 'FILE_SYSTEM', 'MICROSOFT_SQL_DATABASE', 'ORACLE_DATABASE', 'KUBERNETES']
+
+def get_args():
+    # Get command line args from the user
+    parser = argparse.ArgumentParser(
+        description='Mock PowerProtect Data Manager REST API with synthetic data')
+    parser.add_argument('--host', required=False, action='store', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', required=False, action='store', type=int, default=8443,
+                        help='Port to listen on')
+    parser.add_argument('-a', '--activities', required=False, action='store', type=int, default=1000,
+                        help='Number of protection task activities')
+    parser.add_argument('--assets', required=False, action='store', type=int,
+                        help='Number of assets, default a tenth of the activities')
+    parser.add_argument('--days', required=False, action='store', type=int, default=30,
+                        help='Number of days the activities are spread over')
+    parser.add_argument('-l', '--latency', required=False, action='store', type=float, default=0,
+                        help='Delay added to every request, in milliseconds')
+    parser.add_argument('-e', '--error-rate', required=False, action='store', type=float, default=0,
+                        help='Fraction of requests answered with 503')
+    parser.add_argument('--token-ttl', required=False, action='store', type=int, default=3600,
+                        help='Seconds before a login token expires')
+    parser.add_argument('--certfile', required=False, action='store',
+                        help='Certificate to serve HTTPS, plain HTTP is served without it')
+    parser.add_argument('--keyfile', required=False, action='store',
+                        help='Private key of the certificate')
+    parser.add_argument('--fields', required=False, action='store', default='project', choices=['project', 'ignore', 'reject'],
+                        help='How the fields parameter and null filters are handled, reject answers 400 like older PPDM releases')
+    parser.add_argument('--seed', required=False, action='store', type=int, default=1,
+                        help='Seed of the error injection')
+    args = parser.parse_args()
+    return args
+
+class Dataset:
+    # Synthetic PPDM inventory, activity records are generated from their index when a page is requested
+    def __init__(self, activities, assets, days):
+        self.now = datetime.utcnow()
+        self.counts = {'TASK': activities, 'JOB_GROUP': max(1, activities // 10)}
+        self.span = timedelta(days=days).total_seconds()
+        self.assets = assets
+        self.clients = max(1, assets // 5)
+        self.policies = max(1, min(50, assets // 20))
+        self.mtrees = max(1, self.policies // 2)
+
+    def create_time(self, kind, index):
+        # Activities are spaced evenly over the window, index 0 is the newest
+        return self.now - timedelta(seconds=self.span * index / self.counts[kind])
+
+    def index_after(self, kind, timestamp, inclusive=False):
+        # Number of activities created after (or at) timestamp, createTime decreases with the index
+        bound = (self.now - timestamp).total_seconds() * self.counts[kind] / self.span
+        count = math.floor(bound) + 1 if inclusive else math.ceil(bound)
+        return max(0, min(count, self.counts[kind]))
+
+    def activity(self, kind, index):
+        created = self.create_time(kind, index)
+        asset = index % self.assets
+        policy = asset % self.policies
+        size = (asset % 97 + 1) * 1073741824
+        status = STATUSES[(index * 7 + asset) % len(STATUSES)]
+        duration = 60 + (index * 13) % 3600
+        transferred = size // (5 + asset % 20)
+        record = {
+            'id': '{}-{:09d}'.format(kind.lower(), index),
+            'name': 'Protecting asset' if kind == 'TASK' else 'Protecting policy',
+            'category': 'PROTECT', 'subcategory': 'SCHEDULED', 'classType': kind, 'state': 'COMPLETED',
+            'createTime': created.strftime(TIMEFORMAT),
+            'updateTime': (created + timedelta(seconds=duration)).strftime(TIMEFORMAT),
+            'startTime': created.strftime(TIMEFORMAT),
+            'endTime': (created + timedelta(seconds=duration)).strftime(TIMEFORMAT),
+            'duration': duration * 1000,
+            'protectionPolicy': None if index % 53 == 0 else {'id': 'policy-{}'.format(policy), 'name': 'Policy-{:03d}'.format(policy), 'type': 'ACTIVE'},
+            'asset': {'id': 'asset-{}'.format(asset), 'name': 'asset-{:06d}'.format(asset), 'type': ASSET_TYPES[asset % len(ASSET_TYPES)]},
+            'host': {'id': 'host-{}'.format(asset % self.clients), 'name': 'client-{:05d}.example.com'.format(asset % self.clients), 'type': 'APP_HOST'},
+            'result': {'status': status, 'error': {'code': 'ABA0001', 'reason': 'Backup failed'} if status == 'FAILED' else None},
+            'stats': {
+                'assetSizeInBytes': size, 'preCompBytes': size, 'postCompBytes': transferred // 3, 'bytesTransferred': transferred,
+                'dedupeRatio': round(1 + (index % 400) / 20, 2), 'reductionPercentage': round(50 + index % 50, 1),
+                'bytesTransferredThroughput': transferred // duration, 'numberOfAssets': 1 + asset % 10, 'numberOfProtectedAssets': 1 + asset % 10,
+            },
+            'steps': [{'name': 'Backup', 'status': status, 'description': 'Synthetic step {}'.format(step)} for step in range(3)],
+        }
+        return record
+
+    def asset(self, index):
+        kind = ASSET_TYPES[index % len(ASSET_TYPES)]
+        policy = index % self.policies
+        record = {
+            'id': 'asset-{}'.format(index), 'name': 'asset-{:06d}'.format(index), 'type': kind, 'subtype': kind,
+            'protectionStatus': 'PROTECTED' if index % 9 else 'UNPROTECTED',
+            'size': (index % 97 + 1) * 1073741824, 'protectionCapacity': {'size': (index % 97 + 1) * 1073741824},
+            'protectionPolicy': {'id': 'policy-{}'.format(policy), 'name': 'Policy-{:03d}'.format(policy)},
+            'lastAvailableCopyTime': (self.now - timedelta(hours=index % 48)).strftime(TIMEFORMAT),
+            'createdAt': '2020-01-01T00:00:00.000Z',
+            'details': {'vm': {'guestOS': 'Linux', 'vcenterName': 'vcenter-01', 'esxName': 'esx-{:02d}'.format(index % 16), 'disks': [{'id': disk, 'size': 42949672960} for disk in range(4)]}},
+        }
+        return record
+
+    def static(self, path):
+        if path == '/configurations':
+            return [{'id': 'config', 'networks': [{'fqdn': 'ppdmmock.example.com', 'ipAddress': ['127.0.0.1'], 'gateway': '127.0.0.254'}]}]
+        if path == '/protection-policies':
+            return [{'id': 'policy-{}'.format(index), 'name': 'Policy-{:03d}'.format(index), 'assetType': ASSET_TYPES[index % len(ASSET_TYPES)], 'type': 'ACTIVE', 'enabled': True, 'encrypted': False, 'dataConsistency': 'CRASH_CONSISTENT',
+                     'summary': {'numberOfAssets': self.assets // self.policies, 'totalAssetCapacity': 1099511627776, 'totalAssetProtectionCapacity': 1099511627776, 'lastExecutionStatus': 'SUCCEEDED'}} for index in range(self.policies)]
+        if path == '/inventory-sources':
+            return [{'id': 'vcenter-01', 'name': 'vcenter-01', 'type': 'VCENTER', 'version': '8.0', 'lastDiscoveryResult': {'status': 'OK'}, 'address': 'vcenter-01.example.com'}]
+        if path == '/storage-systems':
+            return [{'id': 'dd-{}'.format(index), 'name': 'dd-{:02d}.example.com'.format(index), 'type': 'DATA_DOMAIN_SYSTEM', 'capacityUtilization': 40 + index, 'lastDiscoveryStatus': 'OK', 'lastDiscovered': self.now.strftime(TIMEFORMAT), 'readiness': 'READY',
+                     'details': {'dataDomain': {'totalSize': 109951162777600, 'totalUsed': 43980465111040, 'compressionFactor': 12.5, 'version': '7.13', 'model': 'DD9400', 'serialNumber': 'APM00{:04d}'.format(index)}}} for index in range(2)]
+        if path == '/protection-engines':
+            return [{'id': 'engine-{}'.format(index), 'name': 'vproxy-{:02d}'.format(index), 'type': 'VPE', 'version': '19.16'} for index in range(4)]
+        if path == '/datadomain-mtrees':
+            return [{'id': 'mtree-{}'.format(index), 'name': '/data/col1/mtree-{:03d}'.format(index), 'type': 'DDMTREE', 'lastUpdated': self.now.strftime(TIMEFORMAT), 'createdAt': '2020-01-01T00:00:00.000Z',
+                     'totalCapacityInBytes': 109951162777600, 'availableCapacityInBytes': 65970697666560 - index * 1073741824, 'retentionLockStatus': 'DISABLED', 'retentionLockMode': None, 'replicationTargets': [], 'replicationSources': [],
+                     'attributes': {'dayPreComp': str(1099511627776 + index), 'dayPostComp': str(109951162777 + index), 'dayCompressionFactor': 10.0, 'usedLogicalCapacity': 439804651110 + index, 'serialNo': 'APM00{:04d}'.format(index % 2), 'groupId': 'mtree-group', 'user': 'ddboost'},
+                     '_embedded': {'storageSystem': {'name': 'dd-{:02d}.example.com'.format(index % 2)}}} for index in range(self.mtrees)]
+        if path == '/licenses':
+            return [{'id': 'license', 'licenseKeys': [{'featureName': 'POWERPROTECT SW TRIAL', 'endDate': (self.now + timedelta(days=90)).strftime('%Y-%m-%d'), 'licenseType': 'EVALUATION'}]}]
+        if path == '/server-disaster-recovery-backups':
+            return [{'id': 'dr-0', 'hostname': 'ppdmmock.example.com', 'name': 'server-dr', 'version': '19.16.0-10', 'state': 'SUCCEEDED', 'creationTime': self.now.strftime(TIMEFORMAT), 'backupConsistencyType': 'FULL', 'components': ['SERVER_CONFIG', 'SERVER_DB']}]
+        return None
+
+def parse_filter(dataset, filter):
+    # Only the classType and time bounds of the /activities filters used by ppdmat.py are understood
+    kind = 'JOB_GROUP' if 'JOB_GROUP' in filter else 'TASK'
+    start, end = 0, dataset.counts[kind]
+    for field, op, value in re.findall(r'(createTime|createdTime) (gt|ge|lt|le) "([^"]+)"', filter):
+        timestamp = datetime.strptime(value, TIMEFORMAT) if '.' in value else datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+        if op in ('gt', 'ge'):
+            end = min(end, dataset.index_after(kind, timestamp, op == 'ge'))
+        else:
+            start = max(start, dataset.index_after(kind, timestamp, op == 'lt'))
+    return kind, start, max(start, end)
+
+def project(record, fields):
+    # Copy of the record with just the dotted fields, nested as in the record
+    projected = {}
+    for field in fields:
+        parts = field.split('.')
+        value = record
+        for part in parts:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            target = projected
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+    return projected
+
+def not_null(record, field):
+    value = record
+    for part in field.split('.'):
+        if not isinstance(value, dict):
+            return False
+        value = value.get(part)
+    return value is not None
+
+def make_handler(dataset, latency, error_rate, token_ttl, seed, fields='project'):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    tokens = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, code, body=None, headers=None):
+            data = json.dumps(body).encode() if body is not None else b''
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def inject(self):
+            # Apply the configured latency and errors, returns True when the request was answered
+            if latency:
+                time.sleep(latency / 1000)
+            with lock:
+                failed = rng.random() < error_rate
+            if failed:
+                self.reply(503, {'code': 503, 'reason': 'Injected error'})
+            return failed
+
+        def authorized(self):
+            token = self.headers.get('Authorization', '').replace('Bearer ', '')
+            with lock:
+                expiry = tokens.get(token)
+            if expiry is None or expiry < time.monotonic():
+                self.reply(401, {'code': 401, 'reason': 'Unauthorized'})
+                return False
+            return True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            path = urlparse(self.path).path.replace('/api/v2', '', 1)
+            if self.inject():
+                return
+            if path == '/login':
+                credentials = json.loads(body or b'{}')
+                if not credentials.get('username') or not credentials.get('password'):
+                    return self.reply(401, {'code': 401, 'reason': 'Invalid credentials'})
+                token = '{}-{}'.format(TOKEN, rng.random())
+                with lock:
+                    tokens[token] = time.monotonic() + token_ttl
+                return self.reply(200, {'access_token': token, 'token_type': 'Bearer', 'expires_in': token_ttl})
+            if path == '/logout':
+                if self.authorized():
+                    self.reply(204)
+                return
+            self.reply(404, {'code': 404, 'reason': 'Not found'})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            path = url.path.replace('/api/v2', '', 1)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if self.inject() or not self.authorized():
+                return
+            notnull = re.findall(r'([\w.]+) ne null', query.get('filter', ''))
+            if fields == 'reject' and ('fields' in query or notnull):
+                return self.reply(400, {'code': 400, 'reason': 'Unsupported query parameter'})
+            size = int(query.get('pageSize', 100))
+            offset = int(query['queryState']) if 'queryState' in query else (int(query.get('page', 1)) - 1) * size
+            if path == '/activities':
+                kind, start, end = parse_filter(dataset, query.get('filter', ''))
+                total = end - start
+                content = [dataset.activity(kind, index) for index in range(start + offset, min(end, start + offset + size))]
+            elif path == '/assets':
+                total = dataset.assets
+                content = [dataset.asset(index) for index in range(offset, min(total, offset + size))]
+            else:
+                records = dataset.static(path)
+                if records is None:
+                    return self.reply(404, {'code': 404, 'reason': 'Not found'})
+                total = len(records)
+                content = records[offset:offset + size]
+            page = {'size': size, 'number': offset // size + 1, 'totalPages': (total + size - 1) // size, 'totalElements': total}
+            if offset + size < total:
+                page['queryState'] = str(offset + size)
+            if fields == 'project':
+                # The null filters drop records from the page, the paging stays that of the unfiltered records
+                content = [record for record in content if all(not_null(record, field) for field in notnull)]
+                if 'fields' in query:
+                    content = [project(record, query['fields'].split(',')) for record in content]
+            self.reply(200, {'content': content, 'page': page})
+
+    return Handler
+
+def serve(host, port, dataset, latency=0, error_rate=0, token_ttl=3600, seed=1, certfile=None, keyfile=None, fields='project'):
+    server = ThreadingHTTPServer((host, port), make_handler(dataset, latency, error_rate, token_ttl, seed, fields))
+    server.daemon_threads = True
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    return server
+
+def main():
+    args = get_args()
+    dataset = Dataset(args.activities, args.assets or max(1, args.activities // 10), args.days)
+    server = serve(args.host, args.port, dataset, args.latency, args.error_rate, args.token_ttl, args.seed, args.certfile, args.keyfile, args.fields)
+    print('Serving {} activities and {} assets on {}://{}:{}/api/v2'.format(
+        args.activities, dataset.assets, 'https' if args.certfile else 'http', args.host, server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
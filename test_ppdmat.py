@@ -0,0 +1,434 @@
+import argparse
+import json
+
+import pytest
+
+import ppdmat
+from ppdmat import stream_body, window_params
+
+BODY = {
+    'content': [
+        {'id': 'a1', 'name': 'vm-01', 'stats': {'bytesTransferred': 186831077, 'dedupeRatio': 12.5, 'reductionPercentage': 1.5e-3}},
+        {'id': 'a2', 'name': 'sql é中ü', 'stats': {'bytesTransferred': -42, 'dedupeRatio': 2E+10, 'reductionPercentage': 0.0}},
+        {'id': 'a3', 'flags': [True, False, None], 'empty': {}, 'list': []},
+    ],
+    'page': {'number': 1, 'size': 1000, 'totalPages': 3, 'queryState': 'c2Vj'},
+    'ratio': 1.25e-7,
+    'count': 1234567890123,
+    'neg': -0.5,
+}
+
+def expected(body):
+    # Top level keys come back in order, the items of the content array one at a time
+    pairs = []
+    for key, value in body.items():
+        if key == 'content':
+            pairs.extend((key, item) for item in value)
+        else:
+            pairs.append((key, value))
+    return pairs
+
+def encode(body):
+    return json.dumps(body, ensure_ascii=False).encode('utf-8')
+
+def test_whole_body():
+    assert list(stream_body([encode(BODY)])) == expected(BODY)
+
+@pytest.mark.parametrize('separators', [(',', ':'), (', ', ': ')])
+def test_split_at_every_offset(separators):
+    data = json.dumps(BODY, ensure_ascii=False, separators=separators).encode('utf-8')
+    for offset in range(len(data) + 1):
+        assert list(stream_body([data[:offset], data[offset:]])) == expected(BODY), offset
+
+def test_split_numbers_at_every_pair_of_offsets():
+    # Top level numbers whose exponent, fraction or sign may land at the end of a chunk
+    for number in ['0', '7', '-1', '1.5', '-12.75', '1e5', '1E+05', '2.5e-3', '-6.02E23', '186831077']:
+        data = '{{"value":{},"total":{}}}'.format(number, number).encode('utf-8')
+        for first in range(len(data) + 1):
+            for second in range(first, len(data) + 1):
+                chunks = [data[:first], data[first:second], data[second:]]
+                assert list(stream_body(chunks)) == [('value', json.loads(number)), ('total', json.loads(number))], chunks
+
+def test_single_byte_chunks():
+    data = encode(BODY)
+    assert list(stream_body(data[i:i + 1] for i in range(len(data)))) == expected(BODY)
+
+def test_empty_content():
+    data = b'{"content": [], "page": {"totalPages": 0}}'
+    for offset in range(len(data) + 1):
+        assert list(stream_body([data[:offset], data[offset:]])) == [('page', {'totalPages': 0})]
+
+@pytest.mark.parametrize('data', [b'{"content": [{"id": 1}', b'{"total": 1.', b'{"total": 12', b'{"total": 1e'])
+def test_truncated_body(data):
+    with pytest.raises(ValueError):
+        list(stream_body([data]))
+
+def test_window_params():
+    assert window_params('state eq "OK"', 'createTime DESC', 'createTime', 'L', 'U') == {'filter': 'state eq "OK" and createTime gt "L" and createTime le "U"', 'orderby': 'createTime DESC'}
+    # Endpoints with a time field need neither a filter nor an order
+    assert window_params(None, None, 'createTime', 'L') == {'filter': 'createTime gt "L"'}
+
+def test_inventory_servers_on_one_host(tmp_path, monkeypatch):
+    inventory = tmp_path / 'fleet.csv'
+    inventory.write_text('server,user,password,port\n127.0.0.1,admin,x,28471\n127.0.0.1,admin,x,28499\nppdm01,,,\n')
+    servers = ppdmat.read_inventory(str(inventory), 'admin', 'pw', '8443')
+    assert [entry['name'] for entry in servers] == ['127.0.0.1:28471', '127.0.0.1:28499', 'ppdm01']
+    assert ppdmat.server_store('activities.db', '127.0.0.1:28471') != ppdmat.server_store('activities.db', '127.0.0.1:28499')
+    assert ppdmat.server_store('activities.db', 'ppdm01') == 'activities-ppdm01.db'
+    # Every server keeps its own result, none of them replaces another on the same host
+    monkeypatch.setattr(ppdmat, 'collect_server', lambda entry, *args: {'data': entry['port'], 'timings': [], 'error': None, 'seconds': 0})
+    results = ppdmat.collect_fleet(servers, argparse.Namespace(max_calls=4, fleet_workers=2), None)
+    assert {name: result['data'] for name, result in results.items()} == {'127.0.0.1:28471': '28471', '127.0.0.1:28499': '28499', 'ppdm01': '8443'}
+
+def test_inventory_duplicate_servers(tmp_path):
+    inventory = tmp_path / 'fleet.json'
+    inventory.write_text(json.dumps([{'server': 'ppdm01', 'port': 9443}, {'server': 'ppdm01', 'port': '9443'}]))
+    with pytest.raises(Exception, match='listed twice'):
+        ppdmat.read_inventory(str(inventory), 'admin', 'pw', '8443')
+    # A name tells apart rows that point at the same server
+    inventory.write_text(json.dumps([{'server': 'ppdm01', 'name': 'a'}, {'server': 'ppdm01', 'name': 'b'}]))
+    assert [entry['name'] for entry in ppdmat.read_inventory(str(inventory), 'admin', 'pw', '8443')] == ['a', 'b']
+
+@pytest.mark.parametrize('format', ['xlsx', 'csv', 'jsonl', 'parquet'])
+def test_float32_ratio_written_as_typed(tmp_path, format):
+    if format == 'parquet':
+        pytest.importorskip('pyarrow')
+    df = ppdmat.pd.DataFrame({'Name': ['vm-01', 'vm-02'], 'Dedupe Ratio': ppdmat.np.array([1.05, None], dtype='float32')})
+    output = ppdmat.open_output(format, str(tmp_path / ('report.xlsx' if format == 'xlsx' else 'report')))
+    output.write('Activities', [df])
+    output.close()
+    if format == 'xlsx':
+        value = ppdmat.pd.read_excel(output.path, 'Activities')['Dedupe Ratio'][0]
+    elif format == 'csv':
+        value = (tmp_path / 'report' / 'Activities.csv').read_text().splitlines()[1].split(',')[1]
+    elif format == 'jsonl':
+        value = json.loads((tmp_path / 'report' / 'Activities.jsonl').read_text().splitlines()[0])['Dedupe Ratio']
+    else:
+        value = ppdmat.pd.read_parquet(tmp_path / 'report' / 'Activities.parquet')['Dedupe Ratio'][0]
+    assert str(value) == '1.05'
+
+START = ppdmat.pd.Timestamp('2026-10-01', tz='UTC')
+
+def activities_frame(rows):
+    # Activities newest first, as PPDM returns them: client, policy, hours after START, status, duration in ms, MB transferred, dedupe ratio
+    rows = sorted(rows, key=lambda row: row[2], reverse=True)
+    pd = ppdmat.pd
+    return pd.DataFrame({
+        'Client Name': pd.Categorical([row[0] for row in rows]),
+        'Policy Name': pd.Categorical([row[1] for row in rows]),
+        'createTime': [START + pd.Timedelta(hours=row[2]) for row in rows],
+        'Status': pd.Categorical([row[3] for row in rows]),
+        'Duration (sec)': pd.array([row[4] for row in rows], dtype='Int64'),
+        'Data Transferred': pd.array([row[5] * 1048576 for row in rows], dtype='Int64'),
+        'Dedupe Ratio': ppdmat.np.array([row[6] for row in rows], dtype='float32'),
+    })
+
+def jobgroups_frame(rows):
+    # Job groups: policy, start and end minutes after START, MB/s
+    pd = ppdmat.pd
+    return pd.DataFrame({
+        'Policy Name': pd.Categorical([row[0] for row in rows]),
+        'startTime': [START + pd.Timedelta(minutes=row[1]) for row in rows],
+        'endTime': [START + pd.Timedelta(minutes=row[2]) for row in rows],
+        'Throughput(bytes)': pd.array([row[3] * 1048576 for row in rows], dtype='Int64'),
+    })
+
+def test_failure_streaks():
+    activities = activities_frame([('c1', 'p1', 0, 'OK', 1000, 1, 2), ('c1', 'p1', 1, 'FAILED', 1000, 1, 2), ('c1', 'p1', 2, 'OK_WITH_ERRORS', 1000, 1, 2),
+                                   ('c1', 'p1', 3, 'OK', 1000, 1, 2), ('c1', 'p1', 4, 'CANCELED', 1000, 1, 2),
+                                   ('c2', 'p1', 0, 'OK', 1000, 1, 2), ('c2', 'p1', 5, 'OK', 1000, 1, 2)])
+    df = ppdmat.failure_streaks(activities).set_index(['Scope', 'Name'])
+    # Only OK is a success, OK_WITH_ERRORS and CANCELED extend a streak
+    assert df.loc[('Client', 'c1'), ['Runs', 'Failures', 'Current Streak', 'Longest Streak', 'Success Rate %']].tolist() == [5, 3, 1, 2, 40.0]
+    assert df.loc[('Client', 'c2'), ['Runs', 'Failures', 'Current Streak', 'Longest Streak', 'Success Rate %']].tolist() == [2, 0, 0, 0, 100.0]
+    assert df.loc[('Policy', 'p1'), ['Runs', 'Failures', 'Current Streak', 'Longest Streak']].tolist() == [7, 3, 0, 2]
+    assert df.loc[('Client', 'c1'), 'Last Success'] == START + ppdmat.pd.Timedelta(hours=3)
+
+def test_success_trend():
+    activities = activities_frame([('c1', 'p1', 1, 'OK', 1000, 1, 2), ('c1', 'p1', 2, 'FAILED', 1000, 1, 2),
+                                   ('c1', 'p1', 25, 'OK_WITH_ERRORS', 1000, 1, 2), ('c1', 'p1', 73, 'OK', 1000, 1, 2)])
+    df = ppdmat.success_trend(activities, days=2)
+    assert df['Runs'].tolist() == [2, 1, 0, 1]
+    assert df['Successes'].tolist() == [1, 0, 0, 1]
+    assert df['Success Rate %'].tolist()[:2] == [50.0, 0.0] and df['Success Rate %'].isna().tolist() == [False, False, True, False]
+    assert df['Rolling 2 Day Success Rate %'].tolist() == [50.0, 33.3, 0.0, 100.0]
+
+def test_throughput_percentiles():
+    activities = activities_frame([('c1', 'p1', 0, 'OK', 1000, 10, 2), ('c1', 'p1', 1, 'OK', 1000, 20, 2), ('c1', 'p1', 2, 'OK', 1000, 30, 2),
+                                   ('c2', 'p1', 3, 'OK', 0, 30, 2)])
+    jobgroups = jobgroups_frame([('p1', 0, 10, 5), ('p1', 20, 30, 15)])
+    df = ppdmat.throughput_percentiles(activities, jobgroups).set_index(['Scope', 'Name'])
+    assert df.loc[('Client', 'c1'), ['Runs', 'p50 (MB/s)', 'p95 (MB/s)', 'p99 (MB/s)', 'Mean (MB/s)']].tolist() == [3, 20.0, 29.0, 29.8, 20.0]
+    # A zero duration has no throughput
+    assert ('Client', 'c2') not in df.index
+    assert df.loc[('Policy', 'p1'), ['Runs', 'p50 (MB/s)', 'Mean (MB/s)']].tolist() == [2, 10.0, 10.0]
+
+def test_dedupe_drift():
+    activities = activities_frame([('c1', 'p1', 0, 'OK', 1000, 1, 10), ('c1', 'p1', 48, 'OK', 1000, 1, 8), ('c1', 'p1', 96, 'OK', 1000, 1, 6),
+                                   ('c2', 'p1', 0, 'OK', 1000, 1, 5), ('c2', 'p1', 96, 'OK', 1000, 1, 5)])
+    df = ppdmat.dedupe_drift(activities).set_index('Client Name')
+    assert df.loc['c1', ['Runs', 'Earlier Dedupe', 'Recent Dedupe', 'Drift %', 'Trend (x / day)']].tolist() == [3, 10.0, 7.0, -30.0, -1.0]
+    assert df.loc['c2', ['Drift %', 'Trend (x / day)']].tolist() == [0.0, 0.0]
+    assert df.index[0] == 'c1'
+
+def test_backup_window():
+    jobgroups = jobgroups_frame([('p1', 0, 60, 1), ('p2', 30, 90, 1), ('p1', 120, 150, 1), ('p3', 200, 260, 1), ('p3', 210, 230, 1)])
+    df = ppdmat.backup_window(jobgroups).set_index('Policy Name')
+    assert df.loc['p1', ['Job Groups', 'Avg Concurrent Job Groups', 'Max Concurrent Job Groups', 'Overlapping %']].tolist() == [2, 0.5, 1, 50.0]
+    assert df.loc['p2', ['Job Groups', 'Avg Concurrent Job Groups', 'Avg Duration (min)']].tolist() == [1, 1.0, 60.0]
+    # Job groups of the same policy overlap each other as well
+    assert df.loc['p3', ['Avg Concurrent Job Groups', 'Overlapping %']].tolist() == [1.0, 100.0]
+
+def capacity_history(series):
+    # Daily snapshots of MTrees: name, first day, used GB of each day, total GB
+    gb = 1024 ** 3
+    rows = []
+    for name, day, used, total in series:
+        for offset, value in enumerate(used):
+            rows.append({'Day': (ppdmat.pd.Timestamp(day) + ppdmat.pd.Timedelta(days=offset)).strftime('%Y-%m-%d'), 'Kind': 'MTree', 'System': 'dd01',
+                         'Name': name, 'Total': total * gb, 'Available': (total - value) * gb, 'UsedLogical': value * gb})
+    return ppdmat.pd.DataFrame(rows)
+
+def test_capacity_forecast():
+    history = capacity_history([('linear', '2026-09-01', [100 + 5 * day for day in range(10)], 1000),
+                                ('single', '2026-09-10', [300], 1000),
+                                ('flat', '2026-09-01', [400] * 10, 1000),
+                                ('shrinking', '2026-09-01', [500 - 3 * day for day in range(10)], 1000),
+                                ('overfull', '2026-09-01', [990 + 2 * day for day in range(10)], 1000)])
+    df = ppdmat.capacity_forecast(history).set_index('Name')
+    # 145 GB used of 1000 on the last day and 5 GB more every day
+    assert df.loc['linear', ['Used (GB)', 'Available (GB)', 'Snapshots', 'Growth (GB/day)', 'Days to Full']].tolist() == [145.0, 855.0, 10, 5.0, 171.0]
+    assert df.loc['linear', 'Full Date'] == ppdmat.pd.Timestamp('2026-09-10') + ppdmat.pd.Timedelta(days=171)
+    assert df.loc['flat', 'Growth (GB/day)'] == 0.0
+    assert df.loc['shrinking', 'Growth (GB/day)'] == -3.0
+    # One snapshot gives no growth and a series that does not grow is never full
+    for name in ['single', 'flat', 'shrinking']:
+        assert ppdmat.pd.isna(df.loc[name, 'Days to Full']) and ppdmat.pd.isna(df.loc[name, 'Full Date'])
+    assert ppdmat.pd.isna(df.loc['single', 'Growth (GB/day)'])
+    assert ppdmat.np.isfinite(df['Days to Full'].dropna()).all() and (df['Days to Full'].dropna() >= 0).all()
+    assert df.loc['overfull', ['Available (GB)', 'Growth (GB/day)', 'Days to Full']].tolist() == [-8.0, 2.0, 0.0]
+    assert df.index.tolist()[:2] == ['overfull', 'linear']
+
+class Clock:
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def counting_call(calls, body=b'{}'):
+    def call():
+        calls.append(1)
+        return body
+    return call
+
+def test_cache_coalesces_identical_calls():
+    cache = ppdmat.ResponseCache()
+    calls, release = [], ppdmat.threading.Event()
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return b'{"content": []}'
+    results = []
+    threads = [ppdmat.threading.Thread(target=lambda: results.append(cache.fetch('u/policies', {'page': 1}, 60, call))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while not calls:
+        ppdmat.time.sleep(0.01)
+    ppdmat.time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert [body for body, _ in results] == [b'{"content": []}'] * 8
+    assert (cache.misses, cache.hits + cache.shared) == (1, 7)
+
+def test_cache_does_not_keep_errors():
+    cache = ppdmat.ResponseCache()
+    def call():
+        raise ValueError('down')
+    with pytest.raises(ValueError):
+        cache.fetch('u/policies', None, 60, call)
+    # A failed call is not cached
+    calls = []
+    assert cache.fetch('u/policies', None, 60, counting_call(calls)) == (b'{}', 'miss')
+    assert len(calls) == 1
+
+def test_cache_ttl(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ppdmat.time, 'time', clock)
+    cache, calls = ppdmat.ResponseCache(str(tmp_path)), []
+    assert cache.fetch('u/licenses', None, 10, counting_call(calls)) == (b'{}', 'miss')
+    clock.now += 5
+    assert cache.fetch('u/licenses', None, 10, counting_call(calls)) == (b'{}', 'hit')
+    # Another run reads the entry from disk until it expires
+    assert ppdmat.ResponseCache(str(tmp_path)).fetch('u/licenses', None, 10, counting_call(calls)) == (b'{}', 'hit')
+    assert len(calls) == 1
+    clock.now += 6
+    assert cache.fetch('u/licenses', None, 10, counting_call(calls)) == (b'{}', 'miss')
+    clock.now += 11
+    later = ppdmat.ResponseCache(str(tmp_path))
+    assert later.fetch('u/licenses', None, 10, counting_call(calls)) == (b'{}', 'miss')
+    assert len(calls) == 3
+    # Different parameters are different entries
+    assert later.fetch('u/licenses', {'page': 2}, 10, counting_call(calls)) == (b'{}', 'miss')
+
+def test_cache_refresh(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ppdmat.time, 'time', clock)
+    calls = []
+    ppdmat.ResponseCache(str(tmp_path)).fetch('u/storage-systems', None, 3600, counting_call(calls))
+    clock.now += 60
+    refreshed = ppdmat.ResponseCache(str(tmp_path), refresh=True)
+    assert refreshed.fetch('u/storage-systems', None, 3600, counting_call(calls)) == (b'{}', 'miss')
+    # What this run fetched is used again, a run without refresh reads it from disk
+    clock.now += 60
+    assert refreshed.fetch('u/storage-systems', None, 3600, counting_call(calls)) == (b'{}', 'hit')
+    assert ppdmat.ResponseCache(str(tmp_path)).fetch('u/storage-systems', None, 3600, counting_call(calls)) == (b'{}', 'hit')
+    assert len(calls) == 2
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    body, calls = b'x' * 1000, []
+    cache = ppdmat.ResponseCache(str(tmp_path), maxbytes=2500)
+    for url in ['u/a', 'u/b']:
+        cache.fetch(url, None, 3600, counting_call(calls, body))
+    # u/a was stored first but read last by another run, so u/b goes when u/c does not fit
+    for age, url in [(200, 'u/a'), (100, 'u/b')]:
+        stamp = ppdmat.time.time() - age
+        ppdmat.os.utime(cache.file(cache.key(url, None)), (stamp, stamp))
+    assert ppdmat.ResponseCache(str(tmp_path), maxbytes=2500).fetch('u/a', None, 3600, counting_call(calls, body))[1] == 'hit'
+    cache.fetch('u/c', None, 3600, counting_call(calls, body))
+    assert sorted(ppdmat.os.listdir(tmp_path)) == sorted(ppdmat.os.path.basename(cache.file(cache.key(url, None))) for url in ['u/a', 'u/c'])
+    assert len(calls) == 3
+
+class KeptOpen:
+    # SQLite connection that outlives the close() of sync_window, so an in-memory store is kept between syncs
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def close(self):
+        pass
+
+def test_sync_window_twice(monkeypatch):
+    db = KeptOpen(ppdmat.open_store(':memory:'))
+    monkeypatch.setattr(ppdmat, 'open_store', lambda path: db)
+    server, lowers = [], []
+    def window_pages(api, path, filter, orderby, pagesize, timefield, window, *args, **kwargs):
+        lowers.append(window)
+        yield [record for record in server if ppdmat.pd.Timestamp(record['createTime']) > ppdmat.pd.Timestamp(window)]
+    monkeypatch.setattr(ppdmat, 'window_pages', window_pages)
+    def sync():
+        df = ppdmat.sync_window('memory', 'activities', None, '/activities', None, None, 100, ['id', 'name'], 'createTime', '2026-10-01T00:00:00.000000Z')
+        return df, db.execute('SELECT watermark FROM sync WHERE kind = ?', ('activities',)).fetchone()[0]
+    server += [{'id': 'a1', 'name': 'one', 'createTime': '2026-10-02T10:00:00.000Z'}, {'id': 'a2', 'name': 'two', 'createTime': '2026-10-03T10:00:00.000Z'}]
+    df, watermark = sync()
+    assert sorted(df['id']) == ['a1', 'a2'] and watermark == '2026-10-03T10:00:00.000Z'
+    # The next sync reads back a day before the watermark, the records it gets again replace the stored ones
+    server[1]['name'] = 'two again'
+    server.append({'id': 'a3', 'name': 'three', 'createTime': '2026-10-03T20:00:00.000Z'})
+    df, watermark = sync()
+    assert lowers[-1] == '2026-10-02T10:00:00.000000Z'
+    assert sorted(df['id']) == ['a1', 'a2', 'a3'] and df['id'].is_unique
+    assert df.set_index('id').loc['a2', 'name'] == 'two again'
+    assert watermark == '2026-10-03T20:00:00.000Z'
+    assert db.execute('SELECT COUNT(*) FROM activities').fetchone()[0] == 3
+    # Nothing new keeps the watermark where it was
+    df, watermark = sync()
+    assert len(df) == 3 and watermark == '2026-10-03T20:00:00.000Z'
+
+def snapshot(root, assets, policies, summary):
+    pd = ppdmat.pd
+    return ppdmat.write_snapshot(str(root), {'assets': pd.DataFrame(assets), 'policies': pd.DataFrame(policies)}, pd.DataFrame(summary))
+
+def changes_of(changes):
+    return sorted(tuple('' if ppdmat.pd.isna(value) else str(value) for value in row) for row in changes.itertuples(index=False))
+
+def test_compare_snapshots(tmp_path):
+    pytest.importorskip('pyarrow')
+    asset = lambda id, name, status, policy: {'id': id, 'Name': name, 'Protection Status': status, 'PolicyName': policy}
+    old = snapshot(tmp_path / 'old', [asset('a1', 'vm1', 'PROTECTED', 'gold'), asset('a2', 'vm2', 'PROTECTED', 'gold'), asset('a3', 'vm3', 'UNPROTECTED', None)],
+                   [{'Name': 'gold', 'Type': 'ACTIVE', 'Enabled': True}], {'Name': ['Assets', 'Protected'], 'Value': [3, 2]})
+    new = snapshot(tmp_path / 'new', [asset('a1', 'vm1', 'PROTECTED', 'gold'), asset('a2', 'vm2', 'PROTECTED', 'silver'), asset('a4', 'vm4', 'PROTECTED', 'silver')],
+                   [{'Name': 'gold', 'Type': 'ACTIVE', 'Enabled': False}, {'Name': 'silver', 'Type': 'ACTIVE', 'Enabled': True}],
+                   {'Name': ['Assets', 'Protected'], 'Value': [3, 3]})
+    changes = ppdmat.compare_snapshots(old, new)
+    assert list(changes.columns) == ['Kind', 'Change', 'Key', 'Name', 'Field', 'Old', 'New', 'Delta', 'Delta %']
+    assert changes_of(changes) == sorted([
+        ('Asset', 'Added', 'a4', 'vm4', '', '', '', '', ''),
+        ('Asset', 'Removed', 'a3', 'vm3', '', '', '', '', ''),
+        ('Asset', 'Changed', 'a2', 'vm2', 'PolicyName', 'gold', 'silver', '', ''),
+        ('Policy', 'Added', 'silver', 'silver', '', '', '', '', ''),
+        ('Policy', 'Changed', 'gold', 'gold', 'Enabled', 'True', 'False', '', ''),
+        ('Summary', 'Changed', 'Protected', 'Protected', '', '2', '3', '1.0', '50.0'),
+    ])
+
+def test_compare_fleet_snapshots(tmp_path):
+    pytest.importorskip('pyarrow')
+    asset = lambda server, id, status: {'Server': server, 'id': id, 'Name': 'vm-' + id, 'Protection Status': status, 'PolicyName': 'gold'}
+    policies = [{'Server': 's1', 'Name': 'gold', 'Type': 'ACTIVE'}]
+    old = snapshot(tmp_path / 'old', [asset('s1', 'a1', 'PROTECTED'), asset('s2', 'a1', 'PROTECTED')], policies,
+                   {'Name': ['Assets'], 'Fleet Total': [2], 's1': [1], 's2': [1]})
+    new = snapshot(tmp_path / 'new', [asset('s1', 'a1', 'UNPROTECTED'), asset('s2', 'a1', 'PROTECTED'), asset('s2', 'a5', 'PROTECTED')], policies,
+                   {'Name': ['Assets'], 'Fleet Total': [3], 's1': [1], 's2': [2]})
+    changes = ppdmat.compare_snapshots(old, new)
+    # The same asset id on two servers is two assets, joined on (Server, id)
+    assert changes_of(changes) == sorted([
+        ('Asset', 'Added', 's2', 'a5', 'vm-a5', '', '', '', '', ''),
+        ('Asset', 'Changed', 's1', 'a1', 'vm-a1', 'Protection Status', 'PROTECTED', 'UNPROTECTED', '', ''),
+        ('Summary', 'Changed', 'Fleet Total', 'Assets', 'Assets', '', '2', '3', '1.0', '50.0'),
+        ('Summary', 'Changed', 's2', 'Assets', 'Assets', '', '1', '2', '1.0', '100.0'),
+    ])
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code, self.headers, self.closed = status_code, {}, False
+
+    def close(self):
+        self.closed = True
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise ppdmat.requests.exceptions.HTTPError('{} Error'.format(self.status_code), response=self)
+
+def fake_api(monkeypatch, statuses, retries=2):
+    # PpdmApi whose session answers with the statuses in turn, recording the token of every call
+    api = ppdmat.PpdmApi('ppdm', 'admin', 'pw', 'http://ppdm:8443/api/v2', retries=retries)
+    api.token, api.responses, api.tokens, api.delays = 't1', [], [], []
+    statuses = iter(statuses)
+    def request(method, url, headers=None, **kwargs):
+        api.tokens.append(headers.get('Authorization'))
+        api.responses.append(FakeResponse(next(statuses)))
+        return api.responses[-1]
+    monkeypatch.setattr(api.session, 'request', request)
+    monkeypatch.setattr(api, 'login', lambda: setattr(api, 'token', 't{}'.format(int(api.token[1:]) + 1)))
+    monkeypatch.setattr(api, 'backoff', lambda attempt, response=None: api.delays.append(attempt))
+    return api
+
+def test_request_retries_on_503(monkeypatch):
+    api = fake_api(monkeypatch, [503, 503, 200])
+    response = api.get('/activities', stream=True)
+    assert response.status_code == 200 and response.attempts == 3
+    assert api.delays == [0, 1]
+    # The retried responses gave their connections back to the pool
+    assert [r.closed for r in api.responses] == [True, True, False]
+    api = fake_api(monkeypatch, [503, 503, 503])
+    with pytest.raises(ppdmat.requests.exceptions.HTTPError):
+        api.get('/activities')
+    assert len(api.responses) == 3 and api.delays == [0, 1]
+
+def test_request_refreshes_token_on_401(monkeypatch):
+    api = fake_api(monkeypatch, [401, 200])
+    response = api.get('/activities')
+    assert response.status_code == 200 and response.attempts == 2
+    assert api.tokens == ['Bearer t1', 'Bearer t2'] and api.delays == []
+    assert api.responses[0].closed
+    # A 401 after the retries still gets its refresh, a second 401 is an error
+    api = fake_api(monkeypatch, [503, 503, 401, 200])
+    assert api.get('/activities').attempts == 4
+    api = fake_api(monkeypatch, [401, 401])
+    with pytest.raises(ppdmat.requests.exceptions.HTTPError):
+        api.get('/activities')
+    assert api.tokens == ['Bearer t1', 'Bearer t2']